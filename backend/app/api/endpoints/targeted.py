@@ -1,11 +1,10 @@
-import csv
-import io
 from typing import Dict, List
 
-import chardet
 import pandas as pd
 
 # Import the mid_calculation function from your components.targeted module
+from app.components.compute_executor import compute_executor
+from app.components.schemas import TARGETED_TABLE
 from app.components.targeted_calculation import calculate_mid, mid_calculation
 from app.components.utils import UserInputError
 from fastapi import APIRouter, Form, HTTPException, UploadFile, status
@@ -66,32 +65,20 @@ async def upload(
             detail="There was an error uploading the file. The content could not be read.",
         )
 
-    # Decode the file contents using detected encoding
-    detected_encoding = chardet.detect(contents)
-    file_encoding = detected_encoding["encoding"]
-
-    # Check if the detected file encoding is None
-    if file_encoding is None:
+    # Parsing and the calculation run off the event loop
+    try:
+        df = await compute_executor.run(
+            TARGETED_TABLE.read_upload, contents, delimiter=None
+        )
+    except UserInputError as ue:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="Unable to detect file encoding.",
+            detail=str(ue),
         )
 
-    decoded_contents = contents.decode(file_encoding)
-
-    # Sniff the delimiter
-    sniffer = csv.Sniffer()
-    sample = decoded_contents[:2000]  # Sample size can be adjusted
-    dialect = sniffer.sniff(sample)
-    delimiter = dialect.delimiter
-
-    # Convert the decoded contents to a Pandas DataFrame
-    file_io = io.StringIO(decoded_contents)
-    df = pd.read_csv(file_io, delimiter=delimiter)
-
     try:
         # Process the data using the mid_calculation function
-        json_data = calculate_mid(df, ctrlCondition)
+        json_data = await compute_executor.run(calculate_mid, df, ctrlCondition)
 
     except UserInputError as ue:
         raise HTTPException(
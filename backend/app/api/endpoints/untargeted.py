@@ -1,16 +1,29 @@
-import io
+import contextlib
 import json
 import logging
 import os
 import uuid
+from itertools import product
 from typing import List, Optional
 
-import chardet
 import pandas as pd
-from app.components.calculation import run_mid_calculation
-from app.components.network import Network
+from app.components.calculation import (
+    SWEEP_INPUTS_FILE,
+    run_mid_calculation,
+    run_mid_sweep,
+)
+from app.components.compute_executor import compute_executor
+from app.components.connection_store import ConnectionStore
+from app.components.network import Network, connection_edges
 from app.components.r_scripts import run_isotope_detection, run_lcms_preprocessing
-from app.components.utils import process_csv_file, read_csv_file
+from app.components.schemas import MID_TABLE
+from app.components.timing import Timings
+from app.components.utils import (
+    UserInputError,
+    decode_upload,
+    process_csv_file,
+    read_csv_file,
+)
 from app.core.config import settings
 from app.manager import manager
 from fastapi import (
@@ -24,7 +37,7 @@ from fastapi import (
     WebSocketDisconnect,
     status,
 )
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 
 logger = logging.getLogger(__name__)
 
@@ -217,6 +230,7 @@ def preprocessing_task(
     ms2_directory,
     ms2_params,
 ):
+    timings = Timings("preprocessing", manager, session_id)
     try:
         logger.info(f"/preprocessing Start LCMS preprocessing ({session_id})")
         manager.send_message(session_id, "1/7 Starting LC-MS Preprocessing")
@@ -238,6 +252,7 @@ def preprocessing_task(
             is_ms2,
             ms2_directory,
             ms2_params,
+            timings=timings,
         )
 
         manager.send_message(session_id, "7/7 Finished LC-MS Preprocessing")
@@ -253,6 +268,8 @@ def preprocessing_task(
         manager.send_message(session_id, f"Error: {error_message}")
         manager.update_session_object(session_id, "preprocessing", "error")
         manager.send_session_object(session_id)
+    finally:
+        timings.write(os.path.join(UPLOADS_DIR, session_id))
 
 
 @router.post("/contextualization")
@@ -268,6 +285,8 @@ async def contextualization(
     excludedConditions: List[str] = Form(...),
     unlabeledConditions: List[str] = Form(...),
     sessionId: Optional[str] = Form(None),
+    topK: Optional[int] = Form(None),
+    storeScores: bool = Form(False),
 ) -> JSONResponse:
 
     if sessionId:
@@ -292,55 +311,20 @@ async def contextualization(
             detail="There was an error uploading the file.",
         )
 
-    # Decode the file contents using detected encoding
-    detected_encoding = chardet.detect(contents)
-    file_encoding = detected_encoding["encoding"]
-
-    # Check if the detected file encoding is None
-    if file_encoding is None:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="Unable to detect file encoding.",
-        )
-
-    decoded_contents = contents.decode(file_encoding)
-
-    # Convert the decoded contents to a Pandas DataFrame
-    file_io = io.StringIO(decoded_contents)
-    df = pd.read_csv(file_io)
-
-    # Validate required columns
-    required_columns = [
-        "name",
-        "compound_id",
-        "mass_isotopomer",
-        "mids",
-        "cis",
-        "intensity_mean",
-        "intensity_se",
-        "mz",
-        "rt",
-        "experiment",
-        "condition",
-    ]
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
+    # Decode, parse and validate the file off the event loop
+    try:
+        df = await compute_executor.run(MID_TABLE.read_upload, contents)
+    except UserInputError as ue:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Missing required columns: {', '.join(missing_columns)}.",
+            detail=str(ue),
         )
 
     pathway_data = {}
     if pathwayFile:
         try:
             pathway_contents = await pathwayFile.read()
-            pathway_encoding = chardet.detect(pathway_contents)["encoding"]
-            if pathway_encoding is None:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail="Unable to detect file encoding for pathway file.",
-                )
-            decoded_pathway_contents = pathway_contents.decode(pathway_encoding)
+            decoded_pathway_contents = decode_upload(pathway_contents)
         except Exception:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -369,6 +353,8 @@ async def contextualization(
         m0Threshold,
         excludedConditions,
         unlabeledConditions,
+        topK,
+        storeScores,
     )
 
     return JSONResponse(content={"session_id": session_id})
@@ -386,8 +372,10 @@ def context_task(
     m0Threshold,
     excludedConditions,
     unlabeledConditions,
+    topK=None,
+    storeScores=False,
 ):
-
+    timings = Timings("context", manager, session_id)
     try:
         net = Network(
             sumThreshold,
@@ -400,20 +388,31 @@ def context_task(
         )
 
         manager.send_message(session_id, f"0/2 Setting up Network")
-        net.read_pd(df)
+        with timings.span("reading", len(df)):
+            net.read_pd(df)
         if pathway_data:
             manager.send_message(session_id, f"0/2 Setting up Pathway")
-            net.read_pathway(pathway_data)
+            with timings.span("pathway", len(pathway_data)):
+                net.read_pathway(pathway_data)
 
         manager.send_message(session_id, f"1/2 Calculating Contextualization")
-        net.setup_connections(settings.CORE_COUNT, manager, session_id)
-
-        json_data = net.get_json()
+        if not storeScores:
+            # Scores of an earlier run do not match this network
+            ConnectionStore.remove(context_dir)
+        net.setup_connections(
+            settings.CORE_COUNT,
+            manager,
+            session_id,
+            cache_dir=context_dir,
+            top_k=topK,
+            store_dir=context_dir if storeScores else None,
+            timings=timings,
+        )
 
-        # Save json_data to context_dir
+        # Save the graph to context_dir
         file_path = os.path.join(context_dir, "network_graph.json")
-        with open(file_path, "w") as file:
-            json.dump(json_data, file)
+        with timings.span("serialization", len(net.connections)):
+            net.write_json(file_path, compressed=settings.CONTEXT_COMPRESSED)
 
         manager.send_message(session_id, f"2/2 Finished Contextualization")
         manager.update_session_object(session_id, "context", "done")
@@ -426,6 +425,8 @@ def context_task(
         manager.send_message(session_id, f"Error: {error_message}")
         manager.update_session_object(session_id, "context", "error")
         manager.send_session_object(session_id)
+    finally:
+        timings.write(os.path.dirname(context_dir))
 
 
 @router.get("/mid-calculation/{session_id}")
@@ -473,6 +474,7 @@ async def calculation_upload(
     formulaTrail: bool = Form(...),
     sessionId: Optional[str] = Form(None),
     ctrlCondition: Optional[str] = Form(None),
+    keepSweepInputs: bool = Form(False),
 ) -> JSONResponse:
 
     if sessionId:
@@ -511,7 +513,7 @@ async def calculation_upload(
         int_data = await process_csv_file(intFile)
     else:
         int_file_path = os.path.join(session_dir, "results", "feature_intensities.csv")
-        int_data = read_csv_file(int_file_path)
+        int_data = await compute_executor.run(read_csv_file, int_file_path)
 
     if peakFile:
         peak_data = await process_csv_file(peakFile)
@@ -527,7 +529,7 @@ async def calculation_upload(
             )
     else:
         peak_file_path = os.path.join(session_dir, "results", "feature_annotation.csv")
-        peak_data = read_csv_file(peak_file_path)
+        peak_data = await compute_executor.run(read_csv_file, peak_file_path)
 
     group_data = await process_csv_file(groupFile)
 
@@ -586,6 +588,7 @@ async def calculation_upload(
         maxLabel,
         formulaTrail,
         ctrlCondition,
+        keepSweepInputs,
     )
 
     logger.info(f"Return request /calculation-upload ({session_id})")
@@ -611,7 +614,15 @@ def long_running_task(
     maxLabel,
     formulaTrail,
     ctrl_condition,
+    keep_sweep_inputs=False,
 ):
+    timings = Timings("calculation", manager, session_id)
+    # The preprocessed intensities are only kept for /calculation-sweep if
+    # requested, inputs of an earlier calculation would not match the MIDs
+    sweep_dir = os.path.join(os.path.dirname(mid_dir), "mid_sweep")
+    if not keep_sweep_inputs:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(sweep_dir, SWEEP_INPUTS_FILE))
     try:
         logger.info(f"/calculation-upload Start isotope detection ({session_id})")
         manager.send_message(session_id, "1/3 Starting Isotope Detection")
@@ -625,6 +636,7 @@ def long_running_task(
             alpha,
             enrichTol,
             file_path,
+            timings=timings,
         )
         manager.send_message(session_id, "1/3 Finished Isotope Detection")
         logger.info(f"/calculation-upload Start mid calculation ({session_id})")
@@ -643,6 +655,8 @@ def long_running_task(
             manager,
             session_id,
             ctrl_condition,
+            sweep_dir=sweep_dir if keep_sweep_inputs else None,
+            timings=timings,
         )
         manager.send_message(session_id, "3/3 Finished MID Calculation")
         manager.update_session_object(session_id, "calculation", "done")
@@ -659,6 +673,65 @@ def long_running_task(
         manager.send_message(session_id, f"Error: {error_message}")
         manager.update_session_object(session_id, "context", "error")
         manager.send_session_object(session_id)
+    finally:
+        timings.write(os.path.dirname(mid_dir))
+
+
+@router.post("/calculation-sweep")
+async def calculation_sweep(
+    background_tasks: BackgroundTasks,
+    sessionId: str = Form(...),
+    sumThresholds: List[float] = Form(...),
+    minLabels: List[float] = Form(...),
+    minFractions: List[float] = Form(...),
+    maxLabels: List[float] = Form(...),
+) -> JSONResponse:
+    # Evaluate a grid of thresholds on the intensities of an earlier
+    # /calculation-upload of this session, without detecting isotopes again
+    sweep_dir = os.path.join(UPLOADS_DIR, sessionId, "mid_sweep")
+    if not os.path.exists(os.path.join(sweep_dir, SWEEP_INPUTS_FILE)):
+        raise HTTPException(
+            status_code=404,
+            detail="No MID calculation with keepSweepInputs found for this session",
+        )
+
+    grid = list(product(sumThresholds, minLabels, minFractions, maxLabels))
+    manager.start_session(sessionId)
+    manager.update_session_object(sessionId, "calculation", "waiting")
+    manager.send_session_object(sessionId)
+    manager.send_message(
+        sessionId, f"Received MID threshold sweep of {len(grid)} combinations"
+    )
+    logger.info(f"Received a request to /calculation-sweep ({sessionId})")
+
+    background_tasks.add_task(sweep_task, sessionId, sweep_dir, grid)
+
+    return JSONResponse(content={"session_id": sessionId, "combinations": len(grid)})
+
+
+def sweep_task(session_id, sweep_dir, grid):
+    timings = Timings("sweep", manager, session_id)
+    try:
+        summary = run_mid_sweep(
+            sweep_dir, grid, settings.CORE_COUNT, manager, session_id, timings
+        )
+        passed = ", ".join(
+            f"{row['file_name']}: {row['passed']} of {row['compounds']}"
+            for row in summary
+        )
+        manager.send_message(session_id, f"Finished MID Threshold Sweep ({passed})")
+        manager.update_session_object(session_id, "calculation", "done")
+        manager.send_session_object(session_id)
+
+        logger.info(f"Finished processing request to /calculation-sweep ({session_id})")
+    except Exception as e:
+        error_message = str(e)
+        logger.error(f"Error in sweep task for session {session_id}: {error_message}")
+        manager.send_message(session_id, f"Error: {error_message}")
+        manager.update_session_object(session_id, "calculation", "error")
+        manager.send_session_object(session_id)
+    finally:
+        timings.write(os.path.dirname(sweep_dir))
 
 
 @router.get("/contextualization/download/{session_id}")
@@ -675,6 +748,49 @@ async def download_context_file(session_id: str):
     )
 
 
+@router.get("/contextualization/edges/{session_id}")
+async def contextualization_edges(
+    session_id: str, maxZscore: float = -1, maxDistance: Optional[float] = None
+):
+    # Select the edges for another threshold from the stored scores
+    context_dir = os.path.join(UPLOADS_DIR, session_id, "context")
+    if not ConnectionStore.exists(context_dir):
+        raise HTTPException(status_code=404, detail="No stored scores found")
+
+    edges = await compute_executor.run(
+        select_edges, context_dir, maxZscore, maxDistance
+    )
+    return ORJSONResponse(content={"edges": edges})
+
+
+def select_edges(context_dir, max_zscore, max_distance):
+    store = ConnectionStore.open(context_dir)
+    scores = store.select(max_zscore, max_distance)
+    return [
+        {"data": edge.to_dict()}
+        for edge in connection_edges(
+            scores, store.nodes, store.experiments, store.conditions
+        )
+    ]
+
+
+@router.get("/contextualization/download/{session_id}/compressed")
+async def download_compressed_context_file(session_id: str):
+    # gzip compressed copy of network_graph.json, decoded by the browser
+    file_path = os.path.join(
+        UPLOADS_DIR, session_id, "context", "network_graph.json.gz"
+    )
+
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    return FileResponse(
+        path=file_path,
+        media_type="application/json",
+        headers={"Content-Encoding": "gzip"},
+    )
+
+
 @router.get("/mid-calculation/download/{session_id}/{filename}")
 async def download_mid_file(session_id: str, filename: str):
     # Construct the file path using session_id and filename
@@ -1,16 +1,27 @@
-from collections import deque
+import os
 
 import numpy as np
-from scipy.spatial.distance import euclidean
 
 
 class MIDAligner:
+    # Traceback codes of the alignment matrix
+    DIAG = 0
+    UP = 1
+    LEFT = 2
+
     class MC:
         def __init__(self, mean_distance, sd_distance):
             self.mean_distance = mean_distance
             self.sd_distance = sd_distance
 
+    # Number of random MID pairs aligned for a Monte Carlo null model
+    mc_samples = 1000
+    # Longest MID that is stored in the persistent Monte Carlo table
+    mc_table_max_length = 64
+
     mc_models = {}
+    mc_table_dir = None
+    mc_tables = {}
 
     def __init__(self, v1, v2, distance, zvalue):
         self.v1 = v1
@@ -27,6 +38,19 @@ class MIDAligner:
     @staticmethod
     def clear_cache():
         MIDAligner.mc_models = {}
+        MIDAligner.mc_tables = {}
+
+    @staticmethod
+    def set_mc_table_dir(table_dir):
+        """Persist Monte Carlo null models in `table_dir`.
+
+        Every process that sets the same directory memory-maps the same tables,
+        so a model is estimated only once for all workers and service restarts.
+        """
+        if table_dir is not None:
+            os.makedirs(table_dir, exist_ok=True)
+        MIDAligner.mc_table_dir = table_dir
+        MIDAligner.mc_tables = {}
 
     def get_mid1(self):
         return self.v1
@@ -45,99 +69,297 @@ class MIDAligner:
         if len(mid1) < 1 or len(mid2) < 1:
             raise Exception("MID vectors must have at least one dimension")
 
-        s_x = len(mid1) + 1
-        s_y = len(mid2) + 1
-        mat_score = np.zeros((s_x, s_y))
-        mat_trace = np.empty((s_x, s_y), dtype=object)
-
-        mat_score[1:, 0] = np.arange(1, s_x) * gap_pen
-        mat_score[0, 1:] = np.arange(1, s_y) * gap_pen
-        mat_trace[1:, 0] = "LEFT"
-        mat_trace[0, 1:] = "UP"
-
-        for y in range(1, s_y):
-            for x in range(1, s_x):
-                s = abs(mid1[x - 1] - mid2[y - 1])
-                s_diag = mat_score[x - 1, y - 1] + s
-                s_up = (
-                    mat_score[x, y - 1] + (abs(x - y) + 1) * gap_pen + abs(mid2[y - 1])
+        aligned1, aligned2, lengths, distances = MIDAligner.align_many(
+            [mid1], [mid2], gap_pen
+        )
+        length = lengths[0]
+
+        return (
+            aligned1[0, :length].tolist(),
+            aligned2[0, :length].tolist(),
+            distances[0],
+        )
+
+    @staticmethod
+    def stack_mids(mids):
+        """Pad a sequence of MID vectors with zeros into a 2D array.
+
+        Returns the padded array and the original length of every vector.
+        """
+        lengths = np.array([len(mid) for mid in mids], dtype=np.intp)
+        stacked = np.zeros((len(mids), lengths.max(initial=0)))
+        for i, mid in enumerate(mids):
+            stacked[i, : lengths[i]] = mid
+        return stacked, lengths
+
+    @staticmethod
+    def align_many(
+        mids1,
+        mids2,
+        gap_pen=0.2,
+        lengths1=None,
+        lengths2=None,
+        max_distances=None,
+    ):
+        """Align many pairs of MID vectors at once.
+
+        `mids1` and `mids2` are zero padded arrays of shape (pairs, isotopologues)
+        and `lengths1`/`lengths2` hold the real length of every vector. The
+        score matrices of all pairs are filled one anti-diagonal at a time, so
+        every cell of a diagonal is computed for the whole batch in a single
+        vectorized step.
+
+        With `max_distances`, pairs whose `distance_bounds` exceed their
+        maximum distance are abandoned before the alignment. Their distance
+        is inf and their alignment is empty.
+
+        Returns the aligned vectors (zero padded), the length of every
+        alignment and the normalized distances, matching `align_vectors`.
+        """
+        if lengths1 is None:
+            mids1, lengths1 = MIDAligner.stack_mids(mids1)
+        if lengths2 is None:
+            mids2, lengths2 = MIDAligner.stack_mids(mids2)
+
+        mids1 = np.asarray(mids1, dtype=float)
+        mids2 = np.asarray(mids2, dtype=float)
+        lengths1 = np.asarray(lengths1, dtype=np.intp)
+        lengths2 = np.asarray(lengths2, dtype=np.intp)
+
+        n = len(lengths1)
+        if n and (lengths1.min() < 1 or lengths2.min() < 1):
+            raise Exception("MID vectors must have at least one dimension")
+
+        # Only the longest vectors of the batch determine the matrix size
+        mids1 = mids1[:, : lengths1.max(initial=0)]
+        mids2 = mids2[:, : lengths2.max(initial=0)]
+
+        if max_distances is not None:
+            bounds = MIDAligner.distance_bounds(mids1, mids2, lengths1, lengths2)
+            max_distances = np.asarray(max_distances, dtype=float)
+            # The bound is summed in another order than the distance
+            abandoned = bounds > max_distances + np.abs(max_distances) * 1e-9
+            if abandoned.any():
+                kept = ~abandoned
+                aligned1, aligned2, steps, distances = MIDAligner.align_many(
+                    mids1[kept], mids2[kept], gap_pen, lengths1[kept], lengths2[kept]
                 )
-                s_left = (
-                    mat_score[x - 1, y] + (abs(x - y) + 1) * gap_pen + abs(mid1[x - 1])
+                # Abandoned pairs have an empty alignment
+                max_steps = mids1.shape[1] + mids2.shape[1]
+                r_mids1 = np.zeros((n, max_steps))
+                r_mids2 = np.zeros((n, max_steps))
+                r_mids1[kept, : aligned1.shape[1]] = aligned1
+                r_mids2[kept, : aligned2.shape[1]] = aligned2
+                all_steps = np.zeros(n, dtype=np.intp)
+                all_steps[kept] = steps
+                norm_dist = np.full(n, np.inf)
+                norm_dist[kept] = distances
+                return r_mids1, r_mids2, all_steps, norm_dist
+
+        s_x = mids1.shape[1] + 1
+        s_y = mids2.shape[1] + 1
+        n_diagonals = s_x + s_y - 1
+
+        # Cells on the anti-diagonal x + y = d only depend on the two previous
+        # diagonals, so the matrix is filled one diagonal at a time for the
+        # whole batch. Only the last two diagonals are kept, indexed by x, and
+        # mids2 is reversed so that all cells of a diagonal are read as
+        # contiguous slices.
+        reversed2 = mids2[:, ::-1]
+        abs_mids1 = np.abs(mids1)
+        abs_reversed2 = np.abs(reversed2)
+        score = [np.zeros((n, s_x)) for _ in range(3)]
+        if s_x > 1:
+            score[1][:, 1] = gap_pen
+        score[1][:, 0] = gap_pen
+
+        # Trace codes of cell (x, d - x) at [d, :, x]
+        mat_trace = np.empty((n_diagonals, n, s_x), dtype=np.int8)
+        mat_trace[1:, :, 0] = MIDAligner.UP
+        for d in range(1, s_x):
+            mat_trace[d, :, d] = MIDAligner.LEFT
+
+        for d in range(2, n_diagonals):
+            lo = max(1, d - s_y + 1)
+            hi = min(s_x - 1, d - 1) + 1
+            x = np.arange(lo, hi)
+            gap = (np.abs(2 * x - d) + 1) * gap_pen
+            # Slices of mids1 at x - 1 and of mids2 at y - 1 = d - x - 1
+            m1 = slice(lo - 1, hi - 1)
+            m2 = slice(s_y - 1 - d + lo, s_y - 1 - d + hi)
+
+            current, last, before_last = score[2], score[1], score[0]
+            s_diag = before_last[:, lo - 1 : hi - 1] + np.abs(
+                mids1[:, m1] - reversed2[:, m2]
+            )
+            s_up = last[:, lo:hi] + gap + abs_reversed2[:, m2]
+            s_left = last[:, lo - 1 : hi - 1] + gap + abs_mids1[:, m1]
+
+            is_diag = (s_diag <= s_up) & (s_diag <= s_left)
+            is_up = ~is_diag & (s_up <= s_left)
+
+            current[:, lo:hi] = np.where(is_diag, s_diag, np.where(is_up, s_up, s_left))
+            if d < s_x:
+                current[:, d] = d * gap_pen
+            if d < s_y:
+                current[:, 0] = d * gap_pen
+            score = [last, current, before_last]
+
+            mat_trace[d, :, lo:hi] = np.where(
+                is_diag,
+                MIDAligner.DIAG,
+                np.where(is_up, MIDAligner.UP, MIDAligner.LEFT),
+            )
+
+        # Trace back all pairs simultaneously, collecting the alignment in
+        # reverse order
+        max_steps = s_x + s_y - 2
+        r_mids1 = np.zeros((n, max_steps))
+        r_mids2 = np.zeros((n, max_steps))
+        steps = np.zeros(n, dtype=np.intp)
+        x, y = lengths1.copy(), lengths2.copy()
+        pairs = np.arange(n)
+
+        for step in range(max_steps):
+            active = (x != 0) | (y != 0)
+            if not active.any():
+                break
+
+            p, px, py = pairs[active], x[active], y[active]
+            direction = mat_trace[px + py, p, px]
+            from_mid1 = direction != MIDAligner.UP
+            from_mid2 = direction != MIDAligner.LEFT
+
+            r_mids1[p, step] = np.where(from_mid1, mids1[p, px - 1], 0.0)
+            r_mids2[p, step] = np.where(from_mid2, mids2[p, py - 1], 0.0)
+
+            x[active] -= from_mid1
+            y[active] -= from_mid2
+            steps[active] += 1
+
+        # Reverse the collected steps of every pair into alignment order
+        order = steps[:, None] - 1 - np.arange(max_steps)
+        valid = order >= 0
+        order = np.where(valid, order, 0)
+        r_mids1 = np.where(valid, np.take_along_axis(r_mids1, order, axis=1), 0.0)
+        r_mids2 = np.where(valid, np.take_along_axis(r_mids2, order, axis=1), 0.0)
+
+        r_mids1 = np.nan_to_num(r_mids1, nan=0.0, posinf=0.0, neginf=0.0)
+        r_mids2 = np.nan_to_num(r_mids2, nan=0.0, posinf=0.0, neginf=0.0)
+
+        # Sum the squares column by column, so the distance of a pair does not
+        # depend on the padding of the batch it was aligned in
+        diff = r_mids1 - r_mids2
+        squares = np.zeros(n)
+        for column in (diff * diff).T:
+            squares += column
+        dist = np.sqrt(squares)
+        norm_dist = np.abs(dist / (lengths1 + lengths2))
+
+        return r_mids1, r_mids2, steps, norm_dist
+
+    @staticmethod
+    def distance_bounds(mids1, mids2, lengths1, lengths2):
+        """Lower bound of the distance of every pair of zero padded MIDs, for
+        any alignment.
+
+        An alignment matches every value of one MID with a value of the other
+        or a gap, so with enough zeros added to both, it is a one-to-one
+        matching of their values. Matching the sorted values has the smallest
+        squared distance of all such matchings.
+        """
+        lengths1 = np.asarray(lengths1)
+        lengths2 = np.asarray(lengths2)
+        width = mids1.shape[1] + mids2.shape[1]
+        sorted1 = np.zeros((len(lengths1), width))
+        sorted2 = np.zeros((len(lengths2), width))
+        # NaNs count as 0 in the distance of the traced back alignment
+        sorted1[:, : mids1.shape[1]] = np.nan_to_num(
+            mids1, nan=0.0, posinf=0.0, neginf=0.0
+        )
+        sorted2[:, : mids2.shape[1]] = np.nan_to_num(
+            mids2, nan=0.0, posinf=0.0, neginf=0.0
+        )
+        sorted1.sort(axis=1)
+        sorted2.sort(axis=1)
+
+        diff = sorted1 - sorted2
+        return np.sqrt((diff * diff).sum(axis=1)) / (lengths1 + lengths2)
+
+    @staticmethod
+    def get_mc_table(gap_pen):
+        """Return the memory-mapped Monte Carlo table for `gap_pen`.
+
+        The table has the shape (max length + 1, max length + 1, 2) and holds
+        the mean and sd distance at [min length, max length]. Entries that
+        have not been estimated yet are NaN.
+        """
+        if MIDAligner.mc_table_dir is None:
+            return None
+
+        if gap_pen not in MIDAligner.mc_tables:
+            path = os.path.join(MIDAligner.mc_table_dir, f"mc_gap_{gap_pen:g}.npy")
+            if not os.path.exists(path):
+                size = MIDAligner.mc_table_max_length + 1
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                table = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=np.float64, shape=(size, size, 2)
                 )
+                table[:] = np.nan
+                table.flush()
+                del table
+                # Linking fails if the table exists, so only the first of
+                # concurrent workers publishes it and all map the same file
+                try:
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(tmp_path)
+            MIDAligner.mc_tables[gap_pen] = np.load(path, mmap_mode="r+")
 
-                if s_diag <= s_up and s_diag <= s_left:
-                    mat_score[x, y] = s_diag
-                    mat_trace[x, y] = "DIAG"
-                elif s_up <= s_left:
-                    mat_score[x, y] = s_up
-                    mat_trace[x, y] = "UP"
-                else:
-                    mat_score[x, y] = s_left
-                    mat_trace[x, y] = "LEFT"
-
-        r_mid1, r_mid2 = deque(), deque()
-        x, y = s_x - 1, s_y - 1
-        while x != 0 or y != 0:
-            direction = mat_trace[x, y]
-            if direction == "DIAG":
-                r_mid1.appendleft(mid1[x - 1])
-                r_mid2.appendleft(mid2[y - 1])
-                x -= 1
-                y -= 1
-            elif direction == "UP":
-                r_mid1.appendleft(0.0)
-                r_mid2.appendleft(mid2[y - 1])
-                y -= 1
-            elif direction == "LEFT":
-                r_mid1.appendleft(mid1[x - 1])
-                r_mid2.appendleft(0.0)
-                x -= 1
-            else:
-                raise Exception("Wrong direction in traceback.")
-
-        if (
-            np.isnan(r_mid1).any()
-            or np.isinf(r_mid1).any()
-            or np.isnan(r_mid2).any()
-            or np.isinf(r_mid2).any()
-        ):
-            r_mid1 = np.nan_to_num(r_mid1, nan=0.0, posinf=0.0, neginf=0.0)
-            r_mid2 = np.nan_to_num(r_mid2, nan=0.0, posinf=0.0, neginf=0.0)
-
-        dist = euclidean(list(r_mid1), list(r_mid2))
-        divide_by = np.sum([len(mid1), len(mid2)])
-        norm_dist = np.abs(dist / divide_by)
-
-        return (list(r_mid1), list(r_mid2), norm_dist)
+        return MIDAligner.mc_tables[gap_pen]
 
     @staticmethod
     def get_monte_carlo_model(l1, l2, gap_pen):
         x = min(l1, l2)
         y = max(l1, l2)
 
-        if (x, y) not in MIDAligner.mc_models:
-            mc = MIDAligner.estimate_monte_carlo_model(l1, l2, gap_pen)
-            MIDAligner.mc_models[(x, y)] = mc
+        if (x, y, gap_pen) in MIDAligner.mc_models:
+            return MIDAligner.mc_models[(x, y, gap_pen)]
+
+        table = None
+        if y <= MIDAligner.mc_table_max_length:
+            table = MIDAligner.get_mc_table(gap_pen)
+
+        if table is not None and not np.isnan(table[x, y, 0]):
+            mc = MIDAligner.MC(table[x, y, 0], table[x, y, 1])
         else:
-            mc = MIDAligner.mc_models[(x, y)]
+            mc = MIDAligner.estimate_monte_carlo_model(x, y, gap_pen)
+            if table is not None:
+                # Write the mean last, it marks the entry as complete
+                table[x, y, 1] = mc.sd_distance
+                table[x, y, 0] = mc.mean_distance
+                table.flush()
 
+        MIDAligner.mc_models[(x, y, gap_pen)] = mc
         return mc
 
     @staticmethod
     def estimate_monte_carlo_model(l1, l2, gap_pen):
-        np.random.seed()
-        distances = np.zeros(1000)
+        # Seeded by the model, so every process estimates the same null model
+        gap_words = np.frombuffer(np.float64(gap_pen).tobytes(), dtype=np.uint32)
+        rng = np.random.default_rng([int(l1), int(l2), *gap_words.tolist()])
 
-        for i in range(1000):
-            v1 = np.random.rand(l1)
-            v1 /= v1.sum()
+        v1 = rng.random((MIDAligner.mc_samples, l1))
+        v1 /= v1.sum(axis=1, keepdims=True)
 
-            v2 = np.random.rand(l2)
-            v2 /= v2.sum()
+        v2 = rng.random((MIDAligner.mc_samples, l2))
+        v2 /= v2.sum(axis=1, keepdims=True)
 
-            _, _, distance = MIDAligner.align_vectors(v1, v2, gap_pen)
-            distances[i] = distance
+        lengths1 = np.full(MIDAligner.mc_samples, l1)
+        lengths2 = np.full(MIDAligner.mc_samples, l2)
+        _, _, _, distances = MIDAligner.align_many(v1, v2, gap_pen, lengths1, lengths2)
 
         mean_distance = distances.mean()
         sd_distance = distances.std()
@@ -145,8 +367,50 @@ class MIDAligner:
         mc = MIDAligner.MC(mean_distance, sd_distance)
         return mc
 
+    @staticmethod
+    def warm_mc_table(max_length, gap_pen=0.2):
+        """Estimate all missing null models up to `max_length` isotopologues."""
+        max_length = min(max_length, MIDAligner.mc_table_max_length)
+        for x in range(1, max_length + 1):
+            for y in range(x, max_length + 1):
+                MIDAligner.get_monte_carlo_model(x, y, gap_pen)
+
     @staticmethod
     def calculate_zvalue(l1, l2, distance, gap_pen):
         mc = MIDAligner.get_monte_carlo_model(l1, l2, gap_pen)
         z = (distance - mc.mean_distance) / mc.sd_distance
         return z
+
+    @staticmethod
+    def null_models(lengths1, lengths2, gap_pen=0.2):
+        """Mean and sd distance of the Monte Carlo model of every MID pair."""
+        lengths1 = np.asarray(lengths1, dtype=np.int64)
+        lengths2 = np.asarray(lengths2, dtype=np.int64)
+        # Models are symmetric, key them by the shorter and longer length
+        shorter = np.minimum(lengths1, lengths2)
+        longer = np.maximum(lengths1, lengths2)
+        base = int(longer.max(initial=0)) + 1
+        keys, inverse = np.unique(shorter * base + longer, return_inverse=True)
+
+        means = np.empty(len(keys))
+        sds = np.empty(len(keys))
+        for k, key in enumerate(keys.tolist()):
+            l1, l2 = divmod(key, base)
+            mc = MIDAligner.get_monte_carlo_model(l1, l2, gap_pen)
+            means[k] = mc.mean_distance
+            sds[k] = mc.sd_distance
+
+        return means[inverse], sds[inverse]
+
+    @staticmethod
+    def calculate_zvalues(lengths1, lengths2, distances, gap_pen=0.2):
+        """Vectorized `calculate_zvalue` for the output of `align_many`."""
+        means, sds = MIDAligner.null_models(lengths1, lengths2, gap_pen)
+        return (np.asarray(distances, dtype=float) - means) / sds
+
+    @staticmethod
+    def max_distances(lengths1, lengths2, max_zscore=-1, gap_pen=0.2):
+        """Largest distance of every MID pair with a z-score of at most
+        `max_zscore`, the inverse of `calculate_zvalues`."""
+        means, sds = MIDAligner.null_models(lengths1, lengths2, gap_pen)
+        return means + max_zscore * sds
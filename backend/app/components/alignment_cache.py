@@ -0,0 +1,96 @@
+import hashlib
+import os
+from typing import Tuple
+
+import numpy as np
+
+
+class AlignmentCache:
+    """Persistent cache of MID pair distances.
+
+    Every entry is keyed by a 64 bit key derived from the content hashes of
+    both MID vectors and the gap penalty, so a pair only has to be aligned
+    again if one of its MIDs changed. The keys are stored sorted next to the
+    distances as .npy files, which worker processes memory-map read-only.
+    """
+
+    keys_file = "alignment_keys.npy"
+    distances_file = "alignment_distances.npy"
+
+    def __init__(self, keys: np.ndarray, distances: np.ndarray):
+        self.keys = keys
+        self.distances = distances
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def open(cls, cache_dir: str) -> "AlignmentCache":
+        keys_path = os.path.join(cache_dir, cls.keys_file)
+        distances_path = os.path.join(cache_dir, cls.distances_file)
+        if not os.path.exists(keys_path) or not os.path.exists(distances_path):
+            return cls(np.empty(0, dtype=np.uint64), np.empty(0))
+
+        keys = np.load(keys_path, mmap_mode="r")
+        distances = np.load(distances_path, mmap_mode="r")
+        if len(keys) != len(distances):
+            # Written by an interrupted run, start over
+            return cls(np.empty(0, dtype=np.uint64), np.empty(0))
+        return cls(keys, distances)
+
+    @staticmethod
+    def hash_mid(values) -> int:
+        """Content hash of a single MID vector."""
+        data = np.asarray(values, dtype=np.float64).tobytes()
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+    @staticmethod
+    def mix(values: np.ndarray) -> np.ndarray:
+        """splitmix64 finalizer, scrambles the bits of uint64 values."""
+        values = values ^ (values >> np.uint64(30))
+        values = values * np.uint64(0xBF58476D1CE4E5B9)
+        values = values ^ (values >> np.uint64(27))
+        values = values * np.uint64(0x94D049BB133111EB)
+        return values ^ (values >> np.uint64(31))
+
+    @staticmethod
+    def pair_keys(hashes1: np.ndarray, hashes2: np.ndarray, gap_pen: float):
+        """Keys of the ordered MID pairs (hashes1, hashes2) aligned with
+        `gap_pen`."""
+        gap_hash = np.array([gap_pen], dtype=np.float64).view(np.uint64)
+        hashes1 = np.asarray(hashes1, dtype=np.uint64)
+        hashes2 = np.asarray(hashes2, dtype=np.uint64)
+        return AlignmentCache.mix(AlignmentCache.mix(hashes1 ^ gap_hash) ^ hashes2)
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return a mask of the cached keys and their distances (NaN if not
+        cached)."""
+        distances = np.full(len(keys), np.nan)
+        if not len(self.keys) or not len(keys):
+            return np.zeros(len(keys), dtype=bool), distances
+
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys
+        distances[found] = self.distances[positions[found]]
+        return found, distances
+
+    def save(self, cache_dir: str, keys: np.ndarray, distances: np.ndarray):
+        """Merge new entries into the cache and write it to `cache_dir`."""
+        keys = np.concatenate([np.asarray(self.keys), keys])
+        distances = np.concatenate([np.asarray(self.distances), distances])
+        keys, first = np.unique(keys, return_index=True)
+        distances = distances[first]
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, array in [
+            (self.keys_file, keys),
+            (self.distances_file, distances),
+        ]:
+            path = os.path.join(cache_dir, name)
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+        self.keys = keys
+        self.distances = distances
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ComputeExecutor:
+    """Bounded thread pool for the CPU heavy steps of request handlers.
+
+    Parsing uploads and calculations that a request waits for run here
+    instead of on the event loop, so other requests and websockets are
+    served in the meantime. At most `max_workers` steps run at once, further
+    steps queue up. Without a started executor, e.g. in scripts and tests,
+    `run` starts one with a small default size.
+    """
+
+    def __init__(self):
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
+
+    def start(self, max_workers: int):
+        with self.lock:
+            if self.executor is not None:
+                return
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="compute"
+            )
+            logger.info(f"Started compute executor with {max_workers} threads")
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is None:
+                return
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Run `func(*args, **kwargs)` in the executor and wait for its
+        result without blocking the event loop."""
+        if self.executor is None:
+            self.start(min(4, os.cpu_count() or 1))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+
+compute_executor = ComputeExecutor()
@@ -0,0 +1,137 @@
+import glob
+import json
+import os
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+
+# Distance and z-score of an aligned MID pair, stored for every pair
+# regardless of the threshold. Fields as in CONNECTION_DTYPE.
+SCORE_DTYPE = np.dtype(
+    [
+        ("source", np.int32),
+        ("target", np.int32),
+        ("experiment", np.int16),
+        ("conditions", np.int32),
+        ("distance", np.float32),
+        ("zscore", np.float32),
+    ]
+)
+
+
+class ConnectionStore:
+    """Distances and z-scores of all aligned MID pairs of a contextualization.
+
+    The scores are written in shards, one .npy file per contextualization
+    task, each sorted by (source, target, experiment, conditions). A small
+    JSON file lists the shards in task order, so together they are sorted,
+    next to the node ids, experiments and conditions the indices refer to.
+    The shards are memory-mapped when the store is opened, so edges for
+    another threshold can be selected without aligning the MIDs again.
+    """
+
+    shard_prefix = "connection_scores"
+    meta_file = "connection_meta.json"
+
+    def __init__(
+        self,
+        shards: List[np.ndarray],
+        nodes: List[Union[str, int]],
+        experiments: List[str],
+        conditions: List[str],
+    ):
+        self.shards = shards
+        self.nodes = nodes
+        self.experiments = experiments
+        self.conditions = conditions
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    @classmethod
+    def exists(cls, store_dir: str) -> bool:
+        return os.path.exists(os.path.join(store_dir, cls.meta_file))
+
+    @classmethod
+    def remove(cls, store_dir: str):
+        """Remove the store from `store_dir`, if there is one."""
+        path = os.path.join(store_dir, cls.meta_file)
+        if os.path.exists(path):
+            os.remove(path)
+        for path in glob.glob(os.path.join(store_dir, f"{cls.shard_prefix}*.npy")):
+            os.remove(path)
+
+    @classmethod
+    def open(cls, store_dir: str) -> "ConnectionStore":
+        with open(os.path.join(store_dir, cls.meta_file), "r") as file:
+            meta = json.load(file)
+        shards = [
+            np.load(os.path.join(store_dir, name), mmap_mode="r")
+            for name in meta["shards"]
+        ]
+        return cls(shards, meta["nodes"], meta["experiments"], meta["conditions"])
+
+    @classmethod
+    def write_shard(
+        cls, store_dir: str, number: int, scores: np.ndarray
+    ) -> Optional[str]:
+        """Sort `scores` and write them as shard `number` to `store_dir`.
+
+        Returns the file name of the shard, or None if there are no scores.
+        """
+        if not len(scores):
+            return None
+
+        order = np.lexsort(
+            (
+                scores["conditions"],
+                scores["experiment"],
+                scores["target"],
+                scores["source"],
+            )
+        )
+        name = f"{cls.shard_prefix}_{number:05d}.npy"
+        path = os.path.join(store_dir, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, scores[order])
+        os.replace(tmp_path, path)
+        return name
+
+    @classmethod
+    def save(
+        cls,
+        store_dir: str,
+        shards: List[str],
+        nodes: List[Union[str, int]],
+        experiments: List[str],
+        conditions: List[str],
+    ) -> "ConnectionStore":
+        """Complete the store in `store_dir` from the `shards` written by
+        `write_shard`, in task order."""
+        # The meta file is written last, it marks the store as complete
+        meta: Dict[str, List] = {
+            "shards": list(shards),
+            "nodes": [
+                node.item() if isinstance(node, np.generic) else node for node in nodes
+            ],
+            "experiments": [str(exp) for exp in experiments],
+            "conditions": [str(cond) for cond in conditions],
+        }
+        path = os.path.join(store_dir, cls.meta_file)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, path)
+
+        return cls.open(store_dir)
+
+    def select(self, max_zscore: float = -1, max_distance: float = None) -> np.ndarray:
+        """Scores of the MID pairs with zscore <= `max_zscore` and, if given,
+        distance <= `max_distance`, in stored order."""
+        selected = [np.empty(0, dtype=SCORE_DTYPE)]
+        for shard in self.shards:
+            mask = shard["zscore"] <= max_zscore
+            if max_distance is not None:
+                mask &= shard["distance"] <= max_distance
+            selected.append(shard[mask])
+        return np.concatenate(selected)
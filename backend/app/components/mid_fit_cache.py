@@ -0,0 +1,119 @@
+import hashlib
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+Fit = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+class MIDFitCache:
+    """Persistent cache of least-squares MID fits.
+
+    Every fit is keyed by a 64 bit content hash of its design matrix and
+    targets, so any threshold combination that sets up the same problem
+    reuses its MIDs, r2 and confidence intervals. The keys are stored sorted
+    next to the flattened fits and their offsets as .npy files, which worker
+    processes memory-map read-only. A fit of n MIDs is stored as
+    [r2, mids, cis], 2n + 1 values.
+    """
+
+    keys_file = "mid_fit_keys.npy"
+    offsets_file = "mid_fit_offsets.npy"
+    values_file = "mid_fit_values.npy"
+
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray, values: np.ndarray):
+        self.keys = keys
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def empty(cls) -> "MIDFitCache":
+        return cls(
+            np.empty(0, dtype=np.uint64), np.zeros(1, dtype=np.int64), np.empty(0)
+        )
+
+    @classmethod
+    def open(cls, cache_dir: str) -> "MIDFitCache":
+        paths = [
+            os.path.join(cache_dir, name)
+            for name in [cls.keys_file, cls.offsets_file, cls.values_file]
+        ]
+        if not all(os.path.exists(path) for path in paths):
+            return cls.empty()
+
+        keys, offsets, values = [np.load(path, mmap_mode="r") for path in paths]
+        if len(offsets) != len(keys) + 1 or offsets[-1] != len(values):
+            # Written by an interrupted run, start over
+            return cls.empty()
+        return cls(keys, offsets, values)
+
+    @staticmethod
+    def problem_key(M: np.ndarray, y: np.ndarray) -> int:
+        """Content hash of the fit of `y` by `M`."""
+        data = np.ascontiguousarray(M, dtype=np.float64)
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(np.array(data.shape, dtype=np.int64).tobytes())
+        digest.update(data.tobytes())
+        digest.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+        return int.from_bytes(digest.digest(), "little")
+
+    def lookup(self, keys: List[int]) -> List[Optional[Fit]]:
+        """Return the cached (mids, r2, cis) of every key, None if not cached."""
+        fits: List[Optional[Fit]] = [None] * len(keys)
+        if not len(self.keys) or not len(keys):
+            return fits
+
+        keys = np.array(keys, dtype=np.uint64)
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        for k in np.flatnonzero(self.keys[positions] == keys):
+            values = self.values[
+                self.offsets[positions[k]] : self.offsets[positions[k] + 1]
+            ]
+            n = (len(values) - 1) // 2
+            fits[k] = (
+                np.array(values[1 : n + 1]),
+                np.array(values[:1]),
+                np.array(values[n + 1 :]),
+            )
+        return fits
+
+    def save(self, cache_dir: str, keys: List[int], fits: List[Fit]):
+        """Merge new fits into the cache and write it to `cache_dir`."""
+        old_values = [
+            np.asarray(self.values[start:stop])
+            for start, stop in zip(self.offsets[:-1], self.offsets[1:])
+        ]
+        new_values = [
+            np.concatenate([np.ravel(r2)[:1], c, cis]).astype(np.float64)
+            for c, r2, cis in fits
+        ]
+        all_keys = np.concatenate(
+            [np.asarray(self.keys), np.array(keys, dtype=np.uint64)]
+        )
+        all_values = old_values + new_values
+        all_keys, first = np.unique(all_keys, return_index=True)
+        all_values = [all_values[k] for k in first]
+
+        offsets = np.zeros(len(all_keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(values) for values in all_values])
+        values = np.concatenate(all_values) if all_values else np.empty(0)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, array in [
+            (self.values_file, values),
+            (self.offsets_file, offsets),
+            (self.keys_file, all_keys),
+        ]:
+            path = os.path.join(cache_dir, name)
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+        self.keys = all_keys
+        self.offsets = offsets
+        self.values = values
@@ -0,0 +1,525 @@
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from app.components.mid_fit_cache import MIDFitCache
+from scipy import stats
+
+
+# Columns of the MIDs calculated per compound, in the order of mid.csv
+MID_COLUMNS = [
+    "id",
+    "name",
+    "compound_id",
+    "formula",
+    "mz",
+    "rt",
+    "mass_isotopomer",
+    "condition",
+    "intensity_mean",
+    "intensity_se",
+    "mids",
+    "cis",
+    "r2",
+]
+
+
+def process_isotope_chunk(
+    chunk,
+    sum_thr,
+    min_label,
+    min_fraction,
+    max_label,
+    ctrl_condition="Ctrl",
+):
+    chunk_index, index, mapping, relative_intensities = chunk
+    columns = isotope_columns(
+        relative_intensities,
+        mapping,
+        sum_thr,
+        min_label,
+        min_fraction,
+        max_label,
+        ctrl_condition,
+    )
+    count = relative_intensities["id"].nunique()
+    return chunk_index, index, count, columns
+
+
+def sweep_isotope_chunk(chunk, grid, cache_dir, ctrl_condition="Ctrl"):
+    chunk_index, index, mapping, relative_intensities = chunk
+    cache = MIDFitCache.open(cache_dir)
+
+    # Fits solved for this chunk, shared by all combinations
+    new_fits = {}
+    # The fit problems only depend on min_fraction and max_label, they are
+    # set up and solved once for all sum and min_label thresholds
+    prepared = {}
+    for min_fraction, max_label in dict.fromkeys((row[2], row[3]) for row in grid):
+        try:
+            compounds, problems, timepoints, size = prepare_isotopes(
+                relative_intensities, mapping, min_fraction, max_label, ctrl_condition
+            )
+            keys = [MIDFitCache.problem_key(M, y) for M, y in problems]
+            solutions = cache.lookup(keys)
+            for k, key in enumerate(keys):
+                if solutions[k] is None:
+                    solutions[k] = new_fits.get(key)
+
+            missing = [k for k, solution in enumerate(solutions) if solution is None]
+            for k, solution in zip(
+                missing, solve_mid_fits([problems[k] for k in missing])
+            ):
+                solutions[k] = solution
+                new_fits[keys[k]] = solution
+            prepared[(min_fraction, max_label)] = (
+                (compounds, solutions, timepoints, size),
+                None,
+            )
+        except Exception as e:
+            prepared[(min_fraction, max_label)] = (None, e)
+
+    results = []
+    for sum_thr, min_label, min_fraction, max_label in grid:
+        fits, error = prepared[(min_fraction, max_label)]
+        try:
+            if error is not None:
+                raise error
+            compounds, solutions, timepoints, size = fits
+            columns = finish_isotopes(
+                relative_intensities,
+                compounds,
+                solutions,
+                timepoints,
+                size,
+                sum_thr,
+                min_label,
+            )
+            results.append((columns, None))
+        except Exception as e:
+            # A failing combination does not stop the others
+            results.append((None, f"{type(e).__name__}: {e}"))
+
+    count = relative_intensities["id"].nunique()
+    return chunk_index, index, count, results, new_fits
+
+
+def mid_design_matrix(vec1, vec2):
+    """Design matrix and targets of the natural abundance corrected fit.
+
+    `vec1` holds the unlabeled and `vec2` the labeled relative intensities,
+    one row per sample. Every pair of an unlabeled and a labeled sample adds
+    one block of rows, ordered by unlabeled sample first.
+    """
+    n_ul, cols = vec1.shape
+    n_l = len(vec2)
+
+    carbon_abu = np.arange(cols) * (0.0107 / 0.9893)
+    corr = (vec1[:, :1] * carbon_abu) / ((vec1[:, 1:2] / vec1[:, :1]) + 1 - carbon_abu)
+
+    # Lower triangular Toeplitz block of every unlabeled sample, with the
+    # M+0 and M+1 entries corrected for the natural 13C abundance
+    n, j = np.tril_indices(cols)
+    block = np.zeros((n_ul, cols, cols))
+    block[:, n, j] = vec1[:, n - j]
+    diagonal = np.arange(1, cols)
+    block[:, diagonal, diagonal] = np.maximum(vec1[:, :1] + corr[:, 1:], 0)
+    block[:, diagonal, diagonal - 1] = np.maximum(vec1[:, 1:2] - corr[:, :-1], 0)
+
+    M = np.repeat(block, n_l, axis=0).reshape(n_ul * n_l * cols, cols)
+    y = np.tile(vec2.reshape(-1), n_ul)
+    return M, y
+
+
+def fit_mid(M, y):
+    rows, cols = M.shape
+    c, residuals, _, _ = np.linalg.lstsq(M, y, rcond=None)
+    tss = np.sum((y - np.mean(y)) ** 2)
+    r2 = 1 - residuals / tss if residuals.size > 0 else 1
+
+    # Calculate confidence intervals
+    dof = len(M) - len(c)
+    mse = residuals / dof
+    cov = mse * np.diagonal(np.linalg.inv(M.T @ M))
+
+    se = np.sqrt(cov)
+    t = stats.t.ppf(0.9, rows - cols)
+    cis = t * se
+    return c, r2, cis
+
+
+def solve_mid_fits(problems):
+    """Least-squares MIDs, r2 and confidence intervals of (M, y) problems.
+
+    Problems of equal shape are solved together with one stacked SVD, using
+    the cutoff of np.linalg.lstsq for small singular values. Problems that
+    are rank deficient or not finite are solved one by one with `fit_mid`.
+    """
+    solutions = [None] * len(problems)
+
+    shapes = defaultdict(list)
+    for index, (M, _) in enumerate(problems):
+        shapes[M.shape].append(index)
+
+    for (rows, cols), indices in shapes.items():
+        M = np.stack([problems[index][0] for index in indices])
+        y = np.stack([problems[index][1] for index in indices])
+
+        finite = np.isfinite(M).all(axis=(1, 2)) & np.isfinite(y).all(axis=1)
+        u, s, vt = np.linalg.svd(
+            np.where(finite[:, None, None], M, 0), full_matrices=False
+        )
+        cutoff = np.finfo(M.dtype).eps * max(rows, cols) * s[:, :1]
+        full_rank = finite & (s > cutoff).all(axis=1) & (rows > cols)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            c = np.einsum("bjk,bj->bk", vt, np.einsum("bij,bi->bj", u, y) / s)
+            residuals = np.sum((y - np.einsum("bij,bj->bi", M, c)) ** 2, axis=1)
+            tss = np.sum((y - np.mean(y, axis=1, keepdims=True)) ** 2, axis=1)
+            r2 = 1 - residuals / tss
+
+            # Diagonal of inv(M.T @ M) from the singular value decomposition
+            inv_diagonal = np.sum((vt / s[:, :, None]) ** 2, axis=1)
+            mse = residuals / (rows - cols)
+            cis = stats.t.ppf(0.9, rows - cols) * np.sqrt(mse[:, None] * inv_diagonal)
+
+        for k, index in enumerate(indices):
+            if full_rank[k]:
+                solutions[index] = (c[k], r2[k : k + 1], cis[k])
+            else:
+                solutions[index] = fit_mid(*problems[index])
+
+    return solutions
+
+
+def process_isotopes(
+    relative_intensities,
+    mapping,
+    sum_thr,
+    min_label,
+    min_fraction,
+    max_label,
+    ctrl_condition="Ctrl",
+):
+    return pd.DataFrame(
+        isotope_columns(
+            relative_intensities,
+            mapping,
+            sum_thr,
+            min_label,
+            min_fraction,
+            max_label,
+            ctrl_condition,
+        )
+    )
+
+
+def isotope_columns(
+    relative_intensities,
+    mapping,
+    sum_thr,
+    min_label,
+    min_fraction,
+    max_label,
+    ctrl_condition="Ctrl",
+):
+    """MIDs of the compounds in `relative_intensities` as a dict of columns,
+    see MID_COLUMNS. The rows of each compound have to be contiguous.
+
+    The fits of all compounds are set up first and solved together, then the
+    timepoints are trimmed and thresholded compound by compound.
+    """
+    compounds, problems, timepoints, size = prepare_isotopes(
+        relative_intensities, mapping, min_fraction, max_label, ctrl_condition
+    )
+    solutions = solve_mid_fits(problems)
+    return finish_isotopes(
+        relative_intensities, compounds, solutions, timepoints, size, sum_thr, min_label
+    )
+
+
+def prepare_isotopes(
+    relative_intensities,
+    mapping,
+    min_fraction,
+    max_label,
+    ctrl_condition="Ctrl",
+):
+    """Fill in missing isotopomers, select the valid conditions and set up the
+    fits of every compound.
+
+    Returns the entries of every compound, the (M, y) problems to solve, the
+    timepoint labels with their sort rank and the number of rows the entries
+    hold. Each compound is a (final, first row, entries) tuple. An entry is a
+    timepoint with the timepoint codes, source rows and mass isotopomers of
+    its rows, a mask of the filled in rows and the index of its problem, or
+    None if its MIDs are NaN. Compounds with too few valid unlabeled
+    conditions are final, with one untrimmed entry spanning all timepoints.
+    """
+    ids = relative_intensities["id"].to_numpy()
+    mass_isotopomers = relative_intensities["mass_isotopomer"].to_numpy(np.int64)
+    relative = relative_intensities["relative_intensity"].to_numpy(np.float64)
+
+    # The conditions of the mapping come first, filled in rows refer to them
+    conditions, condition_labels = pd.factorize(
+        np.concatenate(
+            [
+                np.array(list(mapping), dtype=object),
+                relative_intensities["condition"].to_numpy(dtype=object),
+            ]
+        )
+    )
+    fill_conditions = conditions[: len(mapping)]
+    conditions = conditions[len(mapping) :]
+    condition_timepoints, timepoint_labels = pd.factorize(
+        np.array([mapping[label] for label in condition_labels], dtype=object)
+    )
+    is_unlabeled = (
+        pd.Series(timepoint_labels).str.contains(ctrl_condition).to_numpy(bool)
+    )
+    # Timepoints are reported in sorted order
+    timepoint_rank = np.empty(len(timepoint_labels), dtype=np.int64)
+    timepoint_rank[np.argsort(np.array(timepoint_labels, dtype=object))] = np.arange(
+        len(timepoint_labels)
+    )
+
+    boundaries = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    starts = np.concatenate([[0], boundaries]) if len(ids) else boundaries
+    stops = np.append(starts[1:], len(ids))
+
+    compounds = []
+    problems = []
+    size = 0
+    for start, stop in zip(starts, stops):
+        compound_id = ids[start]
+        present = mass_isotopomers[start:stop]
+        missing = np.setdiff1d(np.arange(present.max() + 1), present)
+        n_filled = len(missing) * len(mapping)
+
+        # Missing isotopomers are added with zero intensity for every
+        # condition and the rows are sorted like
+        # DataFrame.sort_values("mass_isotopomer") would
+        mi = np.concatenate([present, np.repeat(missing, len(mapping))])
+        order = np.argsort(mi, kind="quicksort")
+        mi = mi[order]
+        source = np.concatenate([np.arange(start, stop), np.full(n_filled, start)])[
+            order
+        ]
+        filled = np.concatenate(
+            [np.zeros(stop - start, dtype=bool), np.ones(n_filled, dtype=bool)]
+        )[order]
+        condition = np.concatenate(
+            [conditions[start:stop], np.tile(fill_conditions, len(missing))]
+        )[order]
+        rel = np.concatenate([relative[start:stop], np.zeros(n_filled)])[order]
+        timepoint = condition_timepoints[condition]
+        unlabeled = is_unlabeled[timepoint]
+
+        def condition_rows(rows, condition_code):
+            return rows[condition[rows] == condition_code]
+
+        def entry(rows, fit=None):
+            return (timepoint[rows], source[rows], mi[rows], filled[rows], fit)
+
+        def first_mass_isotopomers(rows):
+            _, first = np.unique(mi[rows], return_index=True)
+            return rows[np.sort(first)]
+
+        # Count the unlabeled conditions without NaN values in 'relative_intensity'
+        unlabeled_rows = np.flatnonzero(unlabeled)
+        ul_conditions = pd.unique(condition[unlabeled_rows])
+        ul_samples = []
+        for condition_code in ul_conditions:
+            rows = condition_rows(unlabeled_rows, condition_code)
+            if not np.isnan(rel[rows]).any() and rel[rows[0]] >= 1 - max_label:
+                ul_samples.append(condition_code)
+
+        if not len(ul_conditions):
+            raise ValueError(f"Compound {compound_id}: no unlabeled condition")
+        fraction_non_nan = len(ul_samples) / len(ul_conditions)
+
+        labeled_rows = np.flatnonzero(~unlabeled)
+        if fraction_non_nan < min_fraction:
+            # One row per timepoint and mass isotopomer, without trimming
+            _, first = np.unique(
+                timepoint_rank[timepoint[labeled_rows]] * (mi.max() + 1)
+                + mi[labeled_rows],
+                return_index=True,
+            )
+            compounds.append((True, start, [entry(labeled_rows[first])]))
+            size += len(first)
+            continue
+
+        entries = []
+        for timepoint_code in pd.unique(timepoint[labeled_rows]):
+            t_rows = labeled_rows[timepoint[labeled_rows] == timepoint_code]
+            t_conditions = pd.unique(condition[t_rows])
+            valid_conditions = [
+                condition_code
+                for condition_code in t_conditions
+                if not np.isnan(rel[condition_rows(t_rows, condition_code)]).any()
+            ]
+
+            if len(valid_conditions) < len(t_conditions) * min_fraction:
+                entries.append(entry(first_mass_isotopomers(t_rows)))
+                continue
+            timepoint_label = timepoint_labels[timepoint_code]
+            if not valid_conditions:
+                raise ValueError(
+                    f"Compound {compound_id}: no condition of {timepoint_label} "
+                    "is free of NaN values"
+                )
+            if not ul_samples:
+                raise ValueError(
+                    f"Compound {compound_id}: no unlabeled condition is free of "
+                    "NaN values and passes max_label"
+                )
+
+            l_rows = [
+                condition_rows(t_rows, condition_code)
+                for condition_code in valid_conditions
+            ]
+            t_rows = np.concatenate(l_rows)
+            cols = len(condition_rows(unlabeled_rows, ul_samples[0]))
+            rows = cols * len(ul_samples) * len(valid_conditions)
+
+            if cols < 2 or rows < 2:
+                entries.append(entry(first_mass_isotopomers(t_rows)))
+                continue
+
+            vec1 = np.array(
+                [rel[condition_rows(unlabeled_rows, ul)] for ul in ul_samples]
+            )
+            # The correction divides by the unlabeled M+0
+            if (vec1[:, 0] == 0).any():
+                raise ValueError(f"Compound {compound_id}: unlabeled M+0 is zero")
+
+            # Timepoints without degrees of freedom are left out
+            if rows - cols < 1:
+                continue
+
+            representative = first_mass_isotopomers(t_rows)
+            if len(representative) != cols or any(
+                len(l_row) != cols for l_row in l_rows
+            ):
+                raise ValueError(
+                    f"Compound {compound_id}: the conditions of {timepoint_label} "
+                    f"do not have the {cols} mass isotopomers of the unlabeled "
+                    "conditions"
+                )
+            vec2 = np.array([rel[l_row] for l_row in l_rows])
+
+            entries.append(entry(representative, len(problems)))
+            problems.append(mid_design_matrix(vec1, vec2))
+
+        if not entries:
+            raise ValueError(
+                f"Compound {compound_id}: no labeled timepoint can be fitted"
+            )
+        compounds.append((False, start, entries))
+        size += sum(len(entry_source) for _, entry_source, *_ in entries)
+
+    return compounds, problems, (timepoint_labels, timepoint_rank), size
+
+
+def finish_isotopes(
+    relative_intensities, compounds, solutions, timepoints, size, sum_thr, min_label
+):
+    """Trim the timepoints of every compound to a common length, apply the
+    sum and min-label thresholds and collect the rows into columns."""
+    timepoint_labels, timepoint_rank = timepoints
+    # TODO: get this from group_data labeling
+    unlabeled_timepoints = ["T0"]
+    labeled_timepoint = ~pd.Index(timepoint_labels).isin(unlabeled_timepoints)
+
+    timepoint = np.empty(size, dtype=np.int64)
+    source = np.empty(size, dtype=np.int64)
+    first = np.empty(size, dtype=np.int64)
+    mass_isotopomer = np.empty(size, dtype=np.int64)
+    filled = np.empty(size, dtype=bool)
+    mids = np.empty(size)
+    cis = np.empty(size)
+    r2 = np.empty(size)
+    position = 0
+
+    for final, start, entries in compounds:
+        fits = []
+        for _, entry_source, _, _, fit in entries:
+            if fit is None:
+                nan = np.full(len(entry_source), np.nan)
+                fits.append((nan, nan, nan))
+            else:
+                c, fit_r2, fit_cis = solutions[fit]
+                fits.append((c, fit_cis, np.repeat(fit_r2, len(c))))
+
+        if not final:
+            # Trim every timepoint to the longest run of MIDs >= 0.01
+            common_length = max(
+                np.flatnonzero(c >= 0.01)[-1] + 1 if (c >= 0.01).any() else 0
+                for c, _, _ in fits
+            )
+            order = np.argsort([timepoint_rank[entry[0][0]] for entry in entries])
+            entries = [
+                tuple(part[:common_length] for part in entries[k][:4]) for k in order
+            ]
+            fits = [
+                tuple(part[:common_length].copy() for part in fits[k]) for k in order
+            ]
+
+            for c, fit_cis, fit_r2 in fits:
+                total = np.nansum(np.abs(c))
+                if len(c) and (total > 1 + sum_thr or total < 1 - sum_thr):
+                    c[:], fit_cis[:], fit_r2[:] = np.nan, np.nan, np.nan
+
+            if min_label > 0:
+                labeled_m0 = [
+                    k
+                    for k, (entry_timepoint, _, entry_mi, _) in enumerate(entries)
+                    if len(entry_mi)
+                    and labeled_timepoint[entry_timepoint[0]]
+                    and (entry_mi == 0).any()
+                ]
+                if all(
+                    (fits[k][0][entries[k][2] == 0] > (1 - min_label)).all()
+                    for k in labeled_m0
+                ):
+                    for k in labeled_m0:
+                        for part in fits[k]:
+                            part[:] = np.nan
+
+        for (entry_timepoint, entry_source, entry_mi, entry_filled, *_), (
+            c,
+            fit_cis,
+            fit_r2,
+        ) in zip(entries, fits):
+            stop = position + len(entry_source)
+            timepoint[position:stop] = entry_timepoint
+            source[position:stop] = entry_source
+            first[position:stop] = start
+            mass_isotopomer[position:stop] = entry_mi
+            filled[position:stop] = entry_filled
+            mids[position:stop] = c
+            cis[position:stop] = fit_cis
+            r2[position:stop] = fit_r2
+            position = stop
+
+    def column(name, rows):
+        return relative_intensities[name].to_numpy()[rows[:position]]
+
+    return {
+        "id": column("id", source),
+        "name": column("name", source),
+        "compound_id": column("compound_id", source),
+        "formula": column("formula", source),
+        "mz": column("compound", source),
+        "rt": column("rt", first),
+        "mass_isotopomer": mass_isotopomer[:position],
+        "condition": np.array(timepoint_labels, dtype=object)[timepoint[:position]],
+        "intensity_mean": np.where(
+            filled[:position], 0, column("intensity_mean", source)
+        ),
+        "intensity_se": np.where(filled[:position], 0, column("intensity_se", source)),
+        "mids": mids[:position],
+        "cis": cis[:position],
+        "r2": r2[:position],
+    }
@@ -0,0 +1,307 @@
+from multiprocessing import shared_memory
+from typing import TYPE_CHECKING, Dict, Iterator, List, Tuple
+
+import numpy as np
+from app.components.alignment_cache import AlignmentCache
+from scipy.spatial import cKDTree
+
+if TYPE_CHECKING:
+    from app.components.network import Network
+
+
+class MIDIndex:
+    """Eligibility of every MID of a network, evaluated once per
+    (node, experiment, condition).
+
+    The MIDs are stored zero padded in `values` with the shape
+    (nodes, experiments, conditions, isotopologues). `lengths` holds the
+    length of every MID and `eligible` marks the MIDs that pass the sum
+    threshold, the M0 labeling limit and the fractional contribution filter
+    of the network. Two nodes can only be connected if both have an eligible
+    MID in the same experiment, which is marked per node and experiment in
+    `experiment_flags`. `hashes` holds a content hash of every MID
+    for the AlignmentCache.
+
+    The arrays can be published through shared memory with `share`, so that
+    worker processes `attach` to them instead of receiving copies.
+    """
+
+    shared_arrays = ["values", "lengths", "eligible", "hashes"]
+
+    def __init__(
+        self,
+        experiments: List[str],
+        conditions: List[str],
+        values: np.ndarray,
+        lengths: np.ndarray,
+        eligible: np.ndarray,
+        hashes: np.ndarray,
+    ):
+        self.experiments = experiments
+        self.conditions = conditions
+        self.values = values
+        self.lengths = lengths
+        self.eligible = eligible
+        self.hashes = hashes
+
+        # Set if the node has an eligible MID in the experiment
+        self.experiment_flags = eligible.any(axis=2)
+
+        self.segments: List[shared_memory.SharedMemory] = []
+
+    @classmethod
+    def from_network(cls, network: "Network") -> "MIDIndex":
+        all_pairs = network.all_pairs or {}
+        experiments = list(all_pairs)
+        conditions = list(
+            dict.fromkeys(
+                condition
+                for pairs in all_pairs.values()
+                for pair in pairs
+                for condition in pair
+            )
+        )
+
+        experiment_index = {exp: i for i, exp in enumerate(experiments)}
+        condition_index = {cond: i for i, cond in enumerate(conditions)}
+
+        shape = (len(network.nodes), len(experiments), len(conditions))
+        lengths = np.zeros(shape, dtype=np.intp)
+        eligible = np.zeros(shape, dtype=bool)
+        hashes = np.zeros(shape, dtype=np.uint64)
+
+        slots = []
+        for n, node in enumerate(network.nodes):
+            # Only the first MID of an (experiment, condition) is used
+            for (experiment, condition), mids in node.mid_lookup.items():
+                e = experiment_index.get(experiment)
+                c = condition_index.get(condition)
+                if e is None or c is None:
+                    continue
+
+                lengths[n, e, c] = len(mids.values)
+                eligible[n, e, c] = network.is_eligible(mids)
+                hashes[n, e, c] = AlignmentCache.hash_mid(mids.values)
+                slots.append((n, e, c, mids.values))
+
+        values = np.zeros(shape + (lengths.max(initial=0),))
+        for n, e, c, mid_values in slots:
+            values[n, e, c, : len(mid_values)] = mid_values
+
+        return cls(experiments, conditions, values, lengths, eligible, hashes)
+
+    def __len__(self) -> int:
+        return len(self.experiment_flags)
+
+    def share(self) -> Dict:
+        """Copy the arrays into shared memory.
+
+        Returns a small picklable spec that workers pass to `attach`. The
+        segments stay alive until `release` is called.
+        """
+        spec = {"experiments": self.experiments, "conditions": self.conditions}
+        for name in self.shared_arrays:
+            array = getattr(self, name)
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+            shared[...] = array
+            setattr(self, name, shared)
+            self.segments.append(segment)
+            spec[name] = (segment.name, array.shape, array.dtype.str)
+        return spec
+
+    def release(self):
+        """Free the shared memory created by `share`."""
+        for name in self.shared_arrays:
+            setattr(self, name, np.array(getattr(self, name)))
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+    @classmethod
+    def attach(cls, spec: Dict) -> "MIDIndex":
+        """Map the arrays published by `share` without copying them.
+
+        Workers have to be started by the process that called `share`, they
+        then use its resource tracker, which keeps the segments alive until
+        `release` unlinks them.
+        """
+        segments = []
+        arrays = {}
+        for name in cls.shared_arrays:
+            segment_name, shape, dtype = spec[name]
+            segment = shared_memory.SharedMemory(name=segment_name)
+            segments.append(segment)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+
+        index = cls(spec["experiments"], spec["conditions"], **arrays)
+        index.segments = segments
+        return index
+
+    def detach(self):
+        """Unmap the arrays of an index created by `attach`."""
+        for name in self.shared_arrays:
+            setattr(self, name, None)
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def candidate_count(self) -> int:
+        """Number of node pairs produced by `iter_candidate_pairs`."""
+        flags, counts = np.unique(self.experiment_flags, axis=0, return_counts=True)
+        active = flags.any(axis=1)
+        flags = flags[active]
+        counts = counts[active]
+
+        total = 0
+        for a in range(len(flags)):
+            total += counts[a] * (counts[a] - 1) // 2
+            overlapping = flags[a + 1 :, flags[a]].any(axis=1)
+            total += counts[a] * counts[a + 1 :][overlapping].sum()
+        return int(total)
+
+    def partners(self, i: int) -> np.ndarray:
+        """Nodes j > i that share an experiment with eligible MIDs with i."""
+        flags = self.experiment_flags[i]
+        if not flags.any():
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(self.experiment_flags[i + 1 :, flags].any(axis=1)) + i + 1
+
+    def iter_candidate_pairs(
+        self, start: int = 0, stop: int = None
+    ) -> Iterator[Tuple[int, int]]:
+        """Lazily yield all node pairs (i, j) with i < j and start <= i < stop
+        that share an experiment in which both have an eligible MID."""
+        stop = len(self) if stop is None else stop
+        for i in range(start, stop):
+            for j in self.partners(i).tolist():
+                yield i, j
+
+    def iter_candidate_mids(
+        self, start: int = 0, stop: int = None, block_size: int = 4096
+    ) -> Iterator[Tuple[np.ndarray, ...]]:
+        """Yield blocks of all eligible MID pairs of the candidate node pairs
+        with start <= i < stop.
+
+        Every block is a tuple of arrays (i, j, experiment, condition of i,
+        condition of j) holding about `block_size` MID pairs. The MID pairs of
+        a node pair are never split across blocks and are ordered like
+        `Network.all_pairs`.
+        """
+        stop = len(self) if stop is None else stop
+        # Split long partner lists, so a block holds at most two block sizes
+        pairs_per_partner = max(self.eligible.shape[1] * self.eligible.shape[2] ** 2, 1)
+        partner_step = max(block_size // pairs_per_partner, 1)
+
+        parts = []
+        size = 0
+        for i in range(start, stop):
+            all_partners = self.partners(i)
+            for offset in range(0, len(all_partners), partner_step):
+                partners = all_partners[offset : offset + partner_step]
+                eligible = (
+                    self.eligible[i][None, :, :, None]
+                    & self.eligible[partners][:, :, None, :]
+                )
+                j, e, c1, c2 = np.nonzero(eligible)
+                parts.append((np.full(len(j), i), partners[j], e, c1, c2))
+                size += len(j)
+
+                if size >= block_size:
+                    yield tuple(np.concatenate(column) for column in zip(*parts))
+                    parts = []
+                    size = 0
+
+        if parts:
+            yield tuple(np.concatenate(column) for column in zip(*parts))
+
+    def iter_pair_mids(
+        self, pairs: np.ndarray, block_size: int = 4096
+    ) -> Iterator[Tuple[np.ndarray, ...]]:
+        """Like `iter_candidate_mids`, but for an explicit (n, 2) array of node
+        pairs."""
+        pairs_per_node_pair = max(
+            self.eligible.shape[1] * self.eligible.shape[2] ** 2, 1
+        )
+        step = max(block_size // pairs_per_node_pair, 1)
+        for offset in range(0, len(pairs), step):
+            i, j = pairs[offset : offset + step].T
+            eligible = self.eligible[i][:, :, :, None] & self.eligible[j][:, :, None, :]
+            p, e, c1, c2 = np.nonzero(eligible)
+            yield i[p], j[p], e, c1, c2
+
+    def row_chunks(self, count: int) -> List[Tuple[int, int]]:
+        """Split the rows into at most `count` ranges (start, stop) with a
+        similar number of candidate pairs each. Every range starts and ends
+        with a row that has partners, rows without partners are left out
+        where possible."""
+        bits = self.experiment_flags.astype(np.intp)
+        # Nodes after every row with eligible MIDs in each experiment
+        later = np.cumsum(bits[::-1], axis=0)[::-1] - bits
+        active = bits.any(axis=1)
+        later_active = np.cumsum(active[::-1])[::-1] - active
+        # Upper bound of the pairs of every row, zero for rows without partners
+        row_work = np.minimum((bits * later).sum(axis=1), later_active)
+        rows = np.flatnonzero(row_work)
+        if len(rows) == 0:
+            return []
+
+        work = np.cumsum(row_work)
+        bounds = np.searchsorted(
+            work, np.linspace(0, work[-1], count + 1)[1:-1], side="left"
+        )
+        bounds = np.unique(np.concatenate([[0], bounds + 1, [len(work)]]))
+        chunks = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            # First and last row with partners in the range
+            first, last = np.searchsorted(rows, [start, stop])
+            if first < last:
+                chunks.append((int(rows[first]), int(rows[last - 1]) + 1))
+        return chunks
+
+    def embed(self) -> np.ndarray:
+        """Fixed length embedding of every MID for the nearest neighbour search.
+
+        The embedding is the cumulative label distribution, padded with its
+        total, followed by the fractional contribution.
+        """
+        cumulative = np.cumsum(self.values, axis=-1)
+
+        weighted = (self.values * np.arange(self.values.shape[-1])).sum(axis=-1)
+        fractional_contribution = np.divide(
+            weighted,
+            self.lengths - 1,
+            out=np.zeros_like(weighted),
+            where=self.lengths > 1,
+        )
+        return np.concatenate([cumulative, fractional_contribution[..., None]], -1)
+
+    def nearest_candidates(self, k: int) -> np.ndarray:
+        """Shortlist node pairs (i, j), i < j, whose eligible MIDs are close in
+        the embedding space.
+
+        Within every experiment each eligible MID is matched with its nearest
+        eligible MIDs of all conditions in a KD-tree. More than `k`
+        neighbours are queried, since several of them may belong to the node
+        itself or to the same partner.
+        """
+        embedding = self.embed()
+        pairs = [np.empty((0, 2), dtype=np.intp)]
+        for e in range(len(self.experiments)):
+            nodes, conditions = np.nonzero(self.eligible[:, e])
+            if len(nodes) < 2:
+                continue
+
+            points = embedding[nodes, e, conditions]
+            n_neighbours = min(len(nodes), (k + 1) * len(self.conditions))
+            _, neighbours = cKDTree(points).query(points, k=n_neighbours)
+
+            i = np.repeat(nodes, n_neighbours)
+            j = nodes[np.reshape(neighbours, -1)]
+            other = i != j
+            pairs.append(
+                np.stack([np.minimum(i, j)[other], np.maximum(i, j)[other]], axis=1)
+            )
+
+        return np.unique(np.concatenate(pairs), axis=0)
@@ -1,13 +1,24 @@
+import contextlib
 import copy
+import gzip
 import math
 import multiprocessing
+import os
 import warnings
-from itertools import product
+from functools import partial
+from itertools import chain, product
 from time import time
-from typing import Dict, List, Union
+from typing import Dict, Iterator, List, Union
 
 import numpy as np
+import orjson
+import pandas as pd
 from app.components.aligner import MIDAligner
+from app.components.alignment_cache import AlignmentCache
+from app.components.connection_store import SCORE_DTYPE, ConnectionStore
+from app.components.mid_index import MIDIndex
+from app.components.timing import Timings, timed_call
+from app.components.worker_pool import worker_pool
 from pandas import DataFrame
 from scipy.stats import f_oneway, ttest_ind_from_stats
 
@@ -17,11 +28,36 @@ multiprocessing.set_start_method("spawn", True)
 
 
 class MIDsTyping:
-    values: List[float]
-    err: List[float]
-    experiment: str
-    condition: str
-    fractional_contribution: float
+    __slots__ = (
+        "values",
+        "err",
+        "experiment",
+        "condition",
+        "fractional_contribution",
+        "abs_sum",
+    )
+
+    def __init__(self, experiment: str, condition: str, values, err):
+        self.experiment = experiment
+        self.condition = condition
+        self.fractional_contribution = self.calculate_fc(values)
+        self.abs_sum = sum([abs(value) for value in values])
+
+        self.values = np.asarray(values, dtype=np.float64)
+        self.err = np.asarray(err, dtype=np.float64)
+
+    @staticmethod
+    def calculate_fc(values: List[float]) -> float:
+        fc = 0.0
+
+        if len(values) <= 1:
+            return fc
+
+        for i in range(len(values)):
+            fc += values[i] * i
+
+        fc /= len(values) - 1
+        return fc
 
     def replace_non_finite(self, val):
         """Replace non-finite float values with None."""
@@ -29,19 +65,31 @@ class MIDsTyping:
             return None
         return val
 
-    def to_dict(self):
+    def to_dict(self, numpy: bool = False):
+        """With `numpy`, the values and errors are returned as arrays for
+        orjson, which writes non-finite values as null itself."""
+        if numpy:
+            return {
+                "values": self.values,
+                "err": self.err,
+                "experiment": str(self.experiment),
+                "condition": str(self.condition),
+            }
         return {
-            "values": [self.replace_non_finite(v) for v in self.values],
-            "err": [self.replace_non_finite(e) for e in self.err],
+            "values": [self.replace_non_finite(v) for v in self.values.tolist()],
+            "err": [self.replace_non_finite(e) for e in self.err.tolist()],
             "experiment": str(self.experiment),
             "condition": str(self.condition),
         }
 
 
 class QuantificationTyping:
-    value: float
-    err: float
-    experiment: str
+    __slots__ = ("value", "err", "experiment")
+
+    def __init__(self, value, err, experiment: str):
+        self.value = value
+        self.err = err
+        self.experiment = experiment
 
     def replace_non_finite(self, val):
         """Replace non-finite float values with None."""
@@ -58,6 +106,24 @@ class QuantificationTyping:
 
 
 class NetworkElement:
+    __slots__ = (
+        "name",
+        "node_id",
+        "id",
+        "mz",
+        "rt",
+        "variability",
+        "quantification",
+        "mids",
+        "mid_lookup",
+        "fc",
+        "fc_pool",
+        "position",
+        "type",
+        "pool_variability",
+        "fc_variability",
+    )
+
     def __init__(
         self, name: str, id: Union[int, None], mz: float, rt: float, type: str = ""
     ):
@@ -74,6 +140,8 @@ class NetworkElement:
         self.variability: List["VariabilityTyping"] = []
         self.quantification: List["QuantificationTyping"] = []
         self.mids: List["MIDsTyping"] = []
+        # First MIDs of every (experiment, condition), see get_mids
+        self.mid_lookup: Dict[tuple, "MIDsTyping"] = {}
         self.fc = []
         self.fc_pool = []
 
@@ -100,7 +168,7 @@ class NetworkElement:
             return None
         return val
 
-    def to_dict(self):
+    def to_dict(self, numpy: bool = False):
         return {
             "name": self.name,
             "id": self.id if self.id is not None else self.name,
@@ -109,7 +177,7 @@ class NetworkElement:
             "rt": self.rt,
             "variability": [var.to_dict() for var in self.variability],
             "quantification": [quant.to_dict() for quant in self.quantification],
-            "mids": [mid.to_dict() for mid in self.mids],
+            "mids": [mid.to_dict(numpy) for mid in self.mids],
             "pool_variability": self.replace_non_finite(self.pool_variability),
             "fc_variability": self.replace_non_finite(self.fc_variability),
             "type": self.type,
@@ -118,35 +186,18 @@ class NetworkElement:
         }
 
     def add_mids(self, experiment, condition, values, err):
-        mids = MIDsTyping()
-        mids.experiment = experiment
-        mids.condition = condition
-        mids.values = values
-        mids.err = err
-        mids.fractional_contribution = self.calculate_fc(values)
+        mids = MIDsTyping(experiment, condition, values, err)
 
         self.mids.append(mids)
+        self.mid_lookup.setdefault((experiment, condition), mids)
 
         return mids.fractional_contribution
 
     def calculate_fc(self, values: List[float]) -> float:
-        fc = 0.0
-
-        if len(values) <= 1:
-            return fc
-
-        for i in range(len(values)):
-            fc += values[i] * i
-
-        fc /= len(values) - 1
-        return fc
+        return MIDsTyping.calculate_fc(values)
 
     def add_quantification(self, value: float, err: float, experiment: str):
-        quant = QuantificationTyping()
-        quant.value = value
-        quant.err = err
-        quant.experiment = experiment
-        self.quantification.append(quant)
+        self.quantification.append(QuantificationTyping(value, err, experiment))
 
     def add_fc(self, fc: float, experiment: str):
         self.fc.append({"value": fc, "experiment": experiment})
@@ -155,9 +206,7 @@ class NetworkElement:
         self.fc_pool.append({"value": fc, "experiment": experiment})
 
     def get_mids(self, experiment, condition) -> Union["MIDsTyping", None]:
-        for mids in self.mids:
-            if mids.experiment == experiment and mids.condition == condition:
-                return mids
+        return self.mid_lookup.get((experiment, condition))
 
     def get_name(self) -> str:
         return self.name
@@ -212,8 +261,12 @@ class NetworkConnection:
 
     def to_dict(self):
         return {
-            "source": self.el1 if isinstance(self.el1, str) else self.el1.get_id(),
-            "target": self.el2 if isinstance(self.el2, str) else self.el2.get_id(),
+            "source": (
+                self.el1.get_id() if isinstance(self.el1, NetworkElement) else self.el1
+            ),
+            "target": (
+                self.el2.get_id() if isinstance(self.el2, NetworkElement) else self.el2
+            ),
             "experiment": str(self.experiment),
             "connections": self.connections,
             "min_distance": self.min_distance,
@@ -279,39 +332,45 @@ class Network:
         self.condition: List[str] = []
 
         self.all_pairs = None
+        self.mid_index: Union["MIDIndex", None] = None
+        self.connections = np.empty(0, dtype=CONNECTION_DTYPE)
 
     def read_pathway(self, pathway: Dict[str, List[str]]):
-        old_nodes = []
+        # First node of every node_id, kept up to date while nodes are added
+        nodes_by_id = {}
+        for net_node in self.nodes:
+            nodes_by_id.setdefault(net_node.node_id, net_node)
+
+        old_nodes = set()
         for node in pathway["elements"]["nodes"]:
-            node_found = False
+            new_node = None
             if "compound_id" in node["data"]:
                 try:
                     compound_id = int(node["data"]["compound_id"])
                 except:
                     compound_id = node["data"]["compound_id"]
                 if compound_id and str(compound_id).strip():
-                    for net_node in self.nodes:
-                        if net_node.node_id == int(compound_id):
-                            if net_node not in old_nodes:
-                                old_nodes.append(net_node)
-                            new_node = copy.deepcopy(net_node)
-                            new_node.id = node["data"]["id"]
-                            new_node.name = node["data"]["Label"]
-
-                            new_node.position = node["position"]
-                            new_node.type = "mapped"
-                            self.nodes.append(new_node)
-                            node_found = True
-                            break
-            if not node_found:
+                    net_node = nodes_by_id.get(int(compound_id))
+                    if net_node is not None:
+                        old_nodes.add(id(net_node))
+                        # The MIDs and quantifications are shared with the
+                        # measured node
+                        new_node = copy.copy(net_node)
+                        new_node.id = node["data"]["id"]
+                        new_node.name = node["data"]["Label"]
+
+                        new_node.position = node["position"]
+                        new_node.type = "mapped"
+            if new_node is None:
                 new_node = NetworkElement(
                     node["data"]["Label"], node["data"]["id"], None, None, "pathway"
                 )
                 new_node.id = node["data"]["id"]
                 new_node.position = node["position"]
-                self.nodes.append(new_node)
+            self.nodes.append(new_node)
+            nodes_by_id.setdefault(new_node.node_id, new_node)
 
-        self.nodes = [elem for elem in self.nodes if elem not in old_nodes]
+        self.nodes = [elem for elem in self.nodes if id(elem) not in old_nodes]
 
         for edge in pathway["elements"]["edges"]:
             new_edge = NetworkConnection(
@@ -325,7 +384,10 @@ class Network:
     def read_pd(self, df: "DataFrame"):
         df["mids"] = df["mids"].fillna(0)
         df["cis"] = df["cis"].fillna(0)
-        df["mass_isotopomer"] = df["mass_isotopomer"].apply(self.transform_isotopomer)
+        # Every distinct label is only parsed once
+        codes, labels = pd.factorize(df["mass_isotopomer"], use_na_sentinel=False)
+        isotopomers = np.array([self.transform_isotopomer(x) for x in labels], int)
+        df["mass_isotopomer"] = isotopomers[codes]
 
         df["experiment"] = df["experiment"].astype(str)
         df["condition"] = df["condition"].astype(str)
@@ -340,96 +402,111 @@ class Network:
         condition_pairs_with_self = list(product(filtered_conditions, repeat=2))
         self.all_pairs = {exp: condition_pairs_with_self for exp in self.experiment}
 
-        for name in df["name"].unique():
-            name_df = df.loc[df["name"] == name]
-
-            if not any(
-                name_df.groupby(["experiment", "condition"])["mids"].apply(
-                    lambda x: len(x) >= self.min_mid_len
-                )
-            ):
-                continue
-
-            valid_m0 = True
-            for exp in self.experiment:
-                for cond in self.unlabeled_conditions:
-                    t0_mids = name_df[
-                        (name_df["experiment"] == exp) & (name_df["condition"] == cond)
-                    ]["mids"]
-
-                    if not t0_mids.empty and t0_mids.iloc[0] < self.m0_threshold:
-                        valid_m0 = False
-                        break
+        # Sort once by (name, experiment, condition). The sort is stable, so
+        # the rows of every group keep their original order.
+        name_codes, names = pd.factorize(df["name"])
+        exp_codes, experiments = pd.factorize(df["experiment"])
+        cond_codes, conditions = pd.factorize(df["condition"])
+        order = np.lexsort((cond_codes, exp_codes, name_codes))
+        order = order[name_codes[order] >= 0]
+
+        group_keys = np.stack(
+            [name_codes[order], exp_codes[order], cond_codes[order]], axis=1
+        )
+        is_start = np.ones(len(order), dtype=bool)
+        is_start[1:] = (group_keys[1:] != group_keys[:-1]).any(axis=1)
+        starts = np.flatnonzero(is_start)
+        stops = np.append(starts[1:], len(order))
+        group_names, group_exps, group_conds = group_keys[starts].T
+
+        # Start and stop of the rows of every (name, experiment, condition),
+        # missing groups are empty
+        shape = (len(names), len(experiments), len(conditions))
+        group_starts = np.zeros(shape, dtype=np.intp)
+        group_stops = np.zeros(shape, dtype=np.intp)
+        group_starts[group_names, group_exps, group_conds] = starts
+        group_stops[group_names, group_exps, group_conds] = stops
+
+        mids = df["mids"].to_numpy()[order]
+        cis = df["cis"].to_numpy()[order]
+        isotopomers = df["mass_isotopomer"].to_numpy()[order]
+        intensity_mean = df["intensity_mean"].to_numpy()[order]
+        intensity_se = df["intensity_se"].to_numpy()[order]
+        if intensity_mean.dtype.kind == "f":
+            intensity_mean = np.where(np.isnan(intensity_mean), 0, intensity_mean)
+        if intensity_se.dtype.kind == "f":
+            intensity_se = np.where(np.isnan(intensity_se), 0, intensity_se)
+
+        # A name needs one (experiment, condition) with enough isotopologues
+        valid = np.zeros(len(names), dtype=bool)
+        valid[group_names[stops - starts >= self.min_mid_len]] = True
+
+        # The first M0 of an unlabeled condition has to be unlabeled
+        unlabeled = np.isin(conditions, self.unlabeled_conditions)[group_conds]
+        labeled_m0 = unlabeled & (mids[starts] < self.m0_threshold)
+        valid[group_names[labeled_m0]] = False
+
+        # The mean over the conditions of one experiment has to exceed
+        # min_quant
+        quants = np.zeros(shape, dtype=intensity_mean.dtype)
+        if len(starts):
+            quants[group_names, group_exps, group_conds] = np.add.reduceat(
+                intensity_mean, starts
+            )
+        valid &= (quants.mean(axis=2) > self.min_quant).any(axis=1)
 
-                if not valid_m0:
-                    break
+        experiment_index = {exp: i for i, exp in enumerate(experiments)}
+        condition_index = {cond: i for i, cond in enumerate(conditions)}
+        experiment_codes = [experiment_index[exp] for exp in self.experiment]
+        condition_codes = [condition_index.get(cond) for cond in self.condition]
 
-            if not valid_m0:
-                continue
+        name_codes_found, first_rows = np.unique(name_codes, return_index=True)
+        first_rows = first_rows[name_codes_found >= 0]
+        compound_ids = df["compound_id"].to_numpy()[first_rows]
+        mzs = df["mz"].to_numpy()[first_rows]
+        rts = df["rt"].to_numpy()[first_rows]
 
+        for n in np.flatnonzero(valid):
             node = NetworkElement(
-                name,
-                (
-                    int(name_df["compound_id"].iloc[0])
-                    if not np.isnan(name_df["compound_id"].iloc[0])
-                    else None
-                ),
-                name_df["mz"].iloc[0],
-                name_df["rt"].iloc[0],
+                names[n],
+                int(compound_ids[n]) if not np.isnan(compound_ids[n]) else None,
+                mzs[n],
+                rts[n],
                 "unknown",
             )
 
             all_quants = []
             all_fc = []
-            for i in range(len(self.experiment)):
-                experiment_quant = 0.0
-                experiment_se = 0.0
-
+            for experiment, e in zip(self.experiment, experiment_codes):
                 experiment_quants = []
                 experiment_ses = []
                 experiment_fc = []
                 experiment_fc_pool = []
-                for condition in self.condition:
-                    sub_df = name_df.loc[
-                        (name_df["experiment"] == self.experiment[i])
-                        & (name_df["condition"] == condition)
-                    ]
-
-                    quant = sub_df["intensity_mean"].sum()
-                    if quant > experiment_quant:
-                        experiment_quant = quant
-                        experiment_se = sub_df["intensity_se"].sum()
+                for condition, c in zip(self.condition, condition_codes):
+                    if c is None:
+                        rows = slice(0, 0)
+                    else:
+                        rows = slice(group_starts[n, e, c], group_stops[n, e, c])
 
-                    sub_df = sub_df.sort_values(by="mass_isotopomer")
+                    quant = intensity_mean[rows].sum()
+                    by_isotopomer = np.argsort(isotopomers[rows])
 
                     fc = node.add_mids(
-                        self.experiment[i],
+                        experiment,
                         condition,
-                        sub_df["mids"].tolist(),
-                        sub_df["cis"].tolist(),
+                        mids[rows][by_isotopomer].tolist(),
+                        cis[rows][by_isotopomer].tolist(),
                     )
                     experiment_fc.append(fc)
                     experiment_quants.append(quant)
                     experiment_fc_pool.append(fc * quant)
-                    experiment_ses.append(sub_df["intensity_se"].sum())
-                node.add_quantification(
-                    experiment_quants, experiment_ses, self.experiment[i]
-                )
-                node.add_fc(experiment_fc, self.experiment[i])
-                node.add_fc_pool(experiment_fc_pool, self.experiment[i])
+                    experiment_ses.append(intensity_se[rows].sum())
+                node.add_quantification(experiment_quants, experiment_ses, experiment)
+                node.add_fc(experiment_fc, experiment)
+                node.add_fc_pool(experiment_fc_pool, experiment)
                 all_quants.append(experiment_quants)
                 all_fc.append(experiment_fc)
 
-            means_above_threshold = False
-            for quant_values in all_quants:
-                if np.mean(quant_values) > self.min_quant:
-                    means_above_threshold = True
-                    break
-
-            # Check if the mean of any experiment is above the threshold
-            if not means_above_threshold:
-                continue  # Skip adding this node
-
             node.calc_pool_variability(all_quants)
             node.calc_fc_variability(all_fc)
 
@@ -441,100 +518,213 @@ class Network:
         else:
             return int(isotopomer)
 
-    def setup_connections(self, core_count: int = 1, manager=None, session_id=None):
-        mid_pairs = [
-            (self.nodes[i], self.nodes[j])
-            for i in range(len(self.nodes))
-            for j in range(i + 1, len(self.nodes))
-        ]
+    def is_eligible(self, mids: "MIDsTyping") -> bool:
+        """Check whether a MID passes the filters required for an alignment."""
+        if len(mids.values) == 0:
+            return False
 
-        total_pairs = len(mid_pairs)
-        last_reported_percent = -1  # To track when to send updates
+        sum_mids = mids.abs_sum
+        if sum_mids < 1 - self.sum_threshold or sum_mids > 1 + self.sum_threshold:
+            return False
 
-        with multiprocessing.Pool(processes=core_count) as pool:
-            results = []
-            for i, res in enumerate(
-                pool.imap_unordered(self.create_connection_wrapper, mid_pairs), start=1
-            ):
-                if res:
-                    results.append(res)
-
-                percent_completed = int(
-                    100 * i / total_pairs
-                )  # Round down to full percent
-                if (
-                    percent_completed > last_reported_percent
-                ):  # Only send updates at full % changes
-                    last_reported_percent = percent_completed
-                    progress_bar = f"[{'#' * (percent_completed // 2)}{'-' * (50 - (percent_completed // 2))}]"
-                    message = f"Progress: {percent_completed}% {progress_bar}"
-                    if manager and session_id:
-                        manager.send_message(session_id, message)
-
-        # Flatten the list of results
-        flattened_list = [item for sublist in results if sublist for item in sublist]
-        self.edges.extend(flattened_list)
-
-    def create_connection_wrapper(self, args):
-        return self.create_connection(*args)
-
-    def create_connection(
-        self, el1: "NetworkElement", el2: "NetworkElement"
-    ) -> Union["NetworkConnection", None]:
-        connections = []
-        if self.all_pairs is not None:
-            for experiment, pairs in self.all_pairs.items():
-                exp_conn = None
-                for index, pair in enumerate(pairs):
-                    mid1 = el1.get_mids(experiment, pair[0])
-                    mid2 = el2.get_mids(experiment, pair[1])
-
-                    if mid1 is None or mid2 is None:
-                        continue
-
-                    sum_mid1 = sum([abs(value) for value in mid1.values])
-                    sum_mid2 = sum([abs(value) for value in mid2.values])
-
-                    if (
-                        sum_mid1 < 1 - self.sum_threshold
-                        or sum_mid2 < 1 - self.sum_threshold
-                        or sum_mid1 > 1 + self.sum_threshold
-                        or sum_mid2 > 1 + self.sum_threshold
-                    ):
-                        continue
+        if mids.values[0] > 1 - self.min_labeling:
+            return False
 
-                    if (
-                        mid1.values[0] > 1 - self.min_labeling
-                        or mid2.values[0] > 1 - self.min_labeling
-                    ):
-                        continue
+        if mids.fractional_contribution < self.min_labeling:
+            return False
 
-                    if (
-                        mid1.fractional_contribution < self.min_labeling
-                        or mid2.fractional_contribution < self.min_labeling
-                    ):
-                        continue
+        return True
 
-                    aligner = MIDAligner.align_MIDs(mid1.values, mid2.values)
-                    zscore = aligner.get_zvalue()
-                    distance = aligner.get_distance()
-                    if zscore <= -1:
-                        if exp_conn is None:
-                            exp_conn = NetworkConnection(el1, el2, experiment)
+    def setup_connections(
+        self,
+        core_count: int = 1,
+        manager=None,
+        session_id=None,
+        cache_dir=None,
+        top_k=None,
+        store_dir=None,
+        timings: Timings = None,
+    ):
+        """Align all candidate node pairs and store the connections that pass
+        the z-score threshold.
+
+        If `cache_dir` is given, the distances of all aligned MID pairs are
+        kept there and only pairs with new or changed MIDs are aligned again
+        on the next run.
+
+        With `top_k`, only the node pairs shortlisted by a nearest neighbour
+        search on MID embeddings are aligned, and an edge is kept if both of
+        its nodes are among each other's `top_k` most similar partners in an
+        experiment, so no node has more than `top_k` partners per experiment.
+
+        If `store_dir` is given, the distances and z-scores of all aligned MID
+        pairs are written to a ConnectionStore there, to select edges for
+        other thresholds later. Every worker writes the scores of its tasks
+        as shards of the store.
+
+        The stages are timed as spans of `timings`.
+        """
+        timings = timings or Timings("context")
+        with timings.span("indexing", len(self.nodes)):
+            self.mid_index = MIDIndex.from_network(self)
+            cache = AlignmentCache.open(cache_dir) if cache_dir else None
+
+            # Workers map the MIDs from shared memory and only receive row
+            # ranges or shortlisted pairs
+            if top_k is None:
+                total_pairs = self.mid_index.candidate_count()
+                tasks = self.mid_index.row_chunks(core_count * 16)
+            else:
+                pairs = self.mid_index.nearest_candidates(top_k)
+                total_pairs = len(pairs)
+                tasks = [
+                    chunk
+                    for chunk in np.array_split(pairs, core_count * 16)
+                    if len(chunk)
+                ]
+        last_reported_percent = -1  # To track when to send updates
 
-                        exp_conn.add_connection(f"{pair[0]}_{pair[1]}", distance)
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+            ConnectionStore.remove(store_dir)
+
+        # No two nodes share an experiment with eligible MIDs
+        if total_pairs == 0:
+            if store_dir is not None:
+                ConnectionStore.save(
+                    store_dir,
+                    [],
+                    [node.get_id() for node in self.nodes],
+                    self.mid_index.experiments,
+                    self.mid_index.conditions,
+                )
+            self.connections = np.empty(0, dtype=CONNECTION_DTYPE)
+            return
+
+        with timings.span("alignment", total_pairs) as span:
+            spec = self.mid_index.share()
+            results = [np.empty(0, dtype=CONNECTION_DTYPE)]
+            shards = [None] * len(tasks)
+            new_keys = [np.empty(0, dtype=np.uint64)]
+            new_distances = [np.empty(0)]
+            try:
+                with worker_pool.acquire(core_count) as pool:
+                    processed_pairs = 0
+                    for result, worker_cpu_time in pool.imap_unordered(
+                        partial(
+                            timed_call,
+                            partial(
+                                create_connections,
+                                spec,
+                                cache_dir=cache_dir,
+                                store_dir=store_dir,
+                            ),
+                        ),
+                        enumerate(tasks),
+                    ):
+                        number, pair_count, connections, aligned, shard = result
+                        span["worker_cpu_time"] += worker_cpu_time
+                        processed_pairs += pair_count
+                        results.append(connections)
+                        shards[number] = shard
+                        new_keys.append(aligned[0])
+                        new_distances.append(aligned[1])
+
+                        percent_completed = int(
+                            100 * processed_pairs / total_pairs
+                        )  # Round down to full percent
+                        if (
+                            percent_completed > last_reported_percent
+                        ):  # Only send updates at full % changes
+                            last_reported_percent = percent_completed
+                            progress_bar = f"[{'#' * (percent_completed // 2)}{'-' * (50 - (percent_completed // 2))}]"
+                            message = f"Progress: {percent_completed}% {progress_bar}"
+                            if manager and session_id:
+                                manager.send_message(session_id, message)
+            finally:
+                self.mid_index.release()
+
+        if cache is not None:
+            new_keys = np.concatenate(new_keys)
+            with timings.span("alignment_cache", len(new_keys)):
+                cache.save(cache_dir, new_keys, np.concatenate(new_distances))
+
+        if store_dir is not None:
+            with timings.span("connection_store") as span:
+                store = ConnectionStore.save(
+                    store_dir,
+                    [shard for shard in shards if shard is not None],
+                    [node.get_id() for node in self.nodes],
+                    self.mid_index.experiments,
+                    self.mid_index.conditions,
+                )
+                span["items"] = len(store)
 
-                if exp_conn is not None:
-                    exp_conn.update_distances()
-                    connections.append(exp_conn)
+        with timings.span("edge_selection") as span:
+            connections = np.concatenate(results)
+            if top_k is not None:
+                connections = self.keep_top_k(connections, top_k)
 
-        return connections
+            order = np.lexsort(
+                (
+                    connections["conditions"],
+                    connections["experiment"],
+                    connections["target"],
+                    connections["source"],
+                )
+            )
+            self.connections = connections[order]
+            span["items"] = len(self.connections)
+
+    @staticmethod
+    def keep_top_k(connections: np.ndarray, k: int) -> np.ndarray:
+        """Keep the connections of the edges whose nodes are among each
+        other's `k` closest partners in an experiment.
+
+        Edges are ranked by their minimum distance over all condition pairs,
+        ties by their order. Requiring the rank of both nodes caps the degree
+        of every node at `k` per experiment, also for hubs that are close to
+        many nodes.
+        """
+        edges, inverse = np.unique(
+            connections[["source", "target", "experiment"]], return_inverse=True
+        )
+        distances = np.full(len(edges), np.inf)
+        np.minimum.at(distances, inverse, connections["distance"])
+
+        # Rank the edges of every node, whether it is their source or target
+        nodes = np.concatenate([edges["source"], edges["target"]])
+        experiments = np.tile(edges["experiment"], 2)
+        order = np.lexsort((np.tile(distances, 2), nodes, experiments))
+        groups = np.stack([experiments[order], nodes[order]], axis=1)
+        starts = np.flatnonzero(np.r_[True, (groups[1:] != groups[:-1]).any(axis=1)])
+        sizes = np.diff(np.r_[starts, len(order)])
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - np.repeat(starts, sizes)
+        keep = (rank < k).reshape(2, -1).all(axis=0)
+
+        return connections[keep[inverse]]
+
+    def iter_connection_edges(self) -> Iterator["NetworkConnection"]:
+        """Build the edges of the aligned node pairs from `connections`."""
+        if not len(self.connections):
+            return iter(())
+
+        return connection_edges(
+            self.connections,
+            self.nodes,
+            self.mid_index.experiments,
+            self.mid_index.conditions,
+        )
 
     def get_json(self):
         nodes = [
             {"data": node.to_dict(), "position": node.position} for node in self.nodes
         ]
-        edges = [{"data": edge.to_dict()} for edge in self.edges]
+        edges = [
+            {"data": edge.to_dict()}
+            for edge in chain(self.edges, self.iter_connection_edges())
+        ]
 
         data = {
             "nodes": nodes,
@@ -544,3 +734,229 @@ class Network:
         }
 
         return data
+
+    def write_json(self, file_path: str, compressed: bool = False):
+        """Stream the graph of `get_json` to `file_path` one element at a time.
+
+        Non-finite values are written as null. With `compressed`, a gzip
+        compressed copy is written to `file_path`.gz as well, otherwise a
+        copy left by an earlier run is removed.
+        """
+        option = orjson.OPT_SERIALIZE_NUMPY
+        compressed_path = f"{file_path}.gz"
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(compressed_path)
+        with contextlib.ExitStack() as stack:
+            files = [stack.enter_context(open(file_path, "wb"))]
+            if compressed:
+                files.append(
+                    stack.enter_context(
+                        gzip.open(f"{compressed_path}.tmp", "wb", compresslevel=6)
+                    )
+                )
+
+            def write(chunk: bytes):
+                for file in files:
+                    file.write(chunk)
+
+            def write_array(key: str, elements: Iterator[dict]):
+                write(b'"' + key.encode() + b'":[')
+                for i, element in enumerate(elements):
+                    if i:
+                        write(b",")
+                    write(orjson.dumps(element, option=option))
+                write(b"]")
+
+            write(b"{")
+            write_array(
+                "nodes",
+                (
+                    {"data": node.to_dict(numpy=True), "position": node.position}
+                    for node in self.nodes
+                ),
+            )
+            write(b",")
+            write_array(
+                "edges",
+                (
+                    {"data": edge.to_dict()}
+                    for edge in chain(self.edges, self.iter_connection_edges())
+                ),
+            )
+            write(b',"experiments":' + orjson.dumps(self.experiment, option=option))
+            write(b',"conditions":' + orjson.dumps(self.condition, option=option))
+            write(b"}")
+
+        # Publish the compressed copy only once it is complete
+        if compressed:
+            os.replace(f"{compressed_path}.tmp", compressed_path)
+
+
+# Compact record of an aligned MID pair that passed the z-score threshold.
+# Nodes are indices into Network.nodes, experiment and conditions index the
+# experiments and conditions of the MIDIndex, where conditions encodes the
+# condition pair (c1, c2) as c1 * number of conditions + c2.
+CONNECTION_DTYPE = np.dtype(
+    [
+        ("source", np.int32),
+        ("target", np.int32),
+        ("experiment", np.int16),
+        ("conditions", np.int32),
+        ("distance", np.float64),
+    ]
+)
+
+
+def connection_edges(
+    connections: np.ndarray, nodes: list, experiments: List[str], conditions: List[str]
+) -> Iterator["NetworkConnection"]:
+    """Build one edge per (source, target, experiment) of connections sorted
+    by these fields.
+
+    `nodes` are the elements or ids the source and target indices refer to.
+    """
+    n_conditions = len(conditions)
+    edge_keys = connections[["source", "target", "experiment"]]
+    starts = np.flatnonzero(np.r_[True, edge_keys[1:] != edge_keys[:-1]])
+    ends = np.r_[starts[1:], len(connections)]
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        first = connections[start]
+        edge = NetworkConnection(
+            nodes[first["source"]],
+            nodes[first["target"]],
+            experiments[first["experiment"]],
+        )
+        for code, distance in zip(
+            connections["conditions"][start:end].tolist(),
+            connections["distance"][start:end].tolist(),
+        ):
+            c1, c2 = divmod(code, n_conditions)
+            edge.add_connection(f"{conditions[c1]}_{conditions[c2]}", distance)
+        edge.update_distances()
+        yield edge
+
+
+# MIDIndex and AlignmentCache attached by this worker process, reused by all
+# chunks of a job
+attached_job: Dict[str, tuple] = {}
+
+
+def create_connections(
+    spec, numbered_task, cache_dir=None, store_dir=None, gap_pen=0.2, block_size=4096
+):
+    """Align the candidate MID pairs of a task on the shared MIDIndex
+    described by `spec`.
+
+    `numbered_task` is a (number, task) tuple. A task is either a range
+    (start, stop) of node rows, of which all candidate pairs are aligned, or
+    an (n, 2) array of node pairs.
+
+    Runs in a worker process. MID pairs found in the AlignmentCache in
+    `cache_dir` are not aligned again. Without `store_dir`, MID pairs whose
+    distance bound rules out a z-score of -1 or less are not aligned. Returns the task number, the number
+    of processed node pairs, the connections as a compact CONNECTION_DTYPE
+    array and the cache keys and distances of the newly aligned MID pairs.
+    With `store_dir`, the distances and z-scores of all MID pairs are
+    written to shard `number` of the ConnectionStore there and the file name
+    of the shard is returned last, otherwise None.
+    """
+    number, task = numbered_task
+    name = spec["values"][0]
+    if name not in attached_job:
+        for index, _ in attached_job.values():
+            index.detach()
+        attached_job.clear()
+        attached_job[name] = (
+            MIDIndex.attach(spec),
+            AlignmentCache.open(cache_dir) if cache_dir else None,
+        )
+    index, cache = attached_job[name]
+
+    if isinstance(task, tuple):
+        blocks = index.iter_candidate_mids(*task, block_size)
+    else:
+        blocks = index.iter_pair_mids(task, block_size)
+
+    pair_count = 0
+    connections = [np.empty(0, dtype=CONNECTION_DTYPE)]
+    new_keys = [np.empty(0, dtype=np.uint64)]
+    new_distances = [np.empty(0)]
+    all_scores = [np.empty(0, dtype=SCORE_DTYPE)]
+    n_conditions = len(index.conditions)
+    for i, j, e, c1, c2 in blocks:
+        if not len(i):
+            continue
+
+        # Node pairs are never split across blocks
+        pair_count += 1 + np.count_nonzero((i[1:] != i[:-1]) | (j[1:] != j[:-1]))
+
+        lengths1 = index.lengths[i, e, c1]
+        lengths2 = index.lengths[j, e, c2]
+
+        if cache is not None:
+            keys = AlignmentCache.pair_keys(
+                index.hashes[i, e, c1], index.hashes[j, e, c2], gap_pen
+            )
+            cached, distances = cache.lookup(keys)
+            missing = ~cached
+        else:
+            distances = np.empty(len(i))
+            missing = np.ones(len(i), dtype=bool)
+
+        if missing.any():
+            # Pairs that cannot become an edge are abandoned, unless the
+            # scores of all pairs are stored
+            max_distances = None
+            if store_dir is None:
+                max_distances = MIDAligner.max_distances(
+                    lengths1[missing], lengths2[missing], gap_pen=gap_pen
+                )
+            _, _, _, distances[missing] = MIDAligner.align_many(
+                index.values[i[missing], e[missing], c1[missing]],
+                index.values[j[missing], e[missing], c2[missing]],
+                gap_pen,
+                lengths1[missing],
+                lengths2[missing],
+                max_distances,
+            )
+            if cache is not None:
+                # Abandoned pairs have no exact distance to cache
+                aligned = missing & np.isfinite(distances)
+                new_keys.append(keys[aligned])
+                new_distances.append(distances[aligned])
+
+        zscores = MIDAligner.calculate_zvalues(lengths1, lengths2, distances, gap_pen)
+
+        hits = zscores <= -1
+        block = np.empty(np.count_nonzero(hits), dtype=CONNECTION_DTYPE)
+        block["source"] = i[hits]
+        block["target"] = j[hits]
+        block["experiment"] = e[hits]
+        block["conditions"] = c1[hits] * n_conditions + c2[hits]
+        block["distance"] = distances[hits]
+        connections.append(block)
+
+        if store_dir is not None:
+            scores = np.empty(len(i), dtype=SCORE_DTYPE)
+            scores["source"] = i
+            scores["target"] = j
+            scores["experiment"] = e
+            scores["conditions"] = c1 * n_conditions + c2
+            scores["distance"] = distances
+            scores["zscore"] = zscores
+            all_scores.append(scores)
+
+    shard = None
+    if store_dir is not None:
+        shard = ConnectionStore.write_shard(
+            store_dir, number, np.concatenate(all_scores)
+        )
+
+    return (
+        number,
+        pair_count,
+        np.concatenate(connections),
+        (np.concatenate(new_keys), np.concatenate(new_distances)),
+        shard,
+    )
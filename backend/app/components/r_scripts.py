@@ -1,10 +1,12 @@
 import logging
 import multiprocessing
+import os
 from typing import List
 
 import pandas as pd
 import rpy2.rinterface_lib.callbacks
 import rpy2.robjects as robjects
+from app.components.timing import Timings
 from rpy2.robjects import pandas2ri
 from rpy2.robjects.vectors import ListVector
 
@@ -262,7 +264,9 @@ def run_lcms_preprocessing(
     is_ms2,
     ms2_directory,
     ms2_params,
+    timings: Timings = None,
 ):
+    timings = timings or Timings("preprocessing")
     queue = multiprocessing.Queue()
     process = multiprocessing.Process(
         target=run_lcms_preprocessing_wrapper,
@@ -286,16 +290,20 @@ def run_lcms_preprocessing(
         ),
     )
 
-    process.start()
-    while True:
-        message = queue.get()
-        if message == "Task Completed":
-            break
-        manager.send_message(session_id, message)
+    # The R process reports its own progress, it is timed as one stage
+    with timings.span("lcms_preprocessing") as span:
+        process.start()
+        while True:
+            message = queue.get()
+            if message == "Task Completed":
+                break
+            manager.send_message(session_id, message)
 
-    process.join()
+        process.join()
+        span["items"] = len(os.listdir(file_directory))
 
-    run_annotation_ranking(output_folder, is_library, is_ms2)
+    with timings.span("annotation_ranking"):
+        run_annotation_ranking(output_folder, is_library, is_ms2)
 
 
 def run_annotation_ranking(output_folder, is_library, is_ms2):
@@ -395,6 +403,33 @@ def run_isotope_detection(
     alpha: float,
     enrich_tol: float,
     isotopes_path: str,
+    timings: Timings = None,
+):
+    timings = timings or Timings("calculation")
+    with timings.span("isotope_detection", len(int_file_data)):
+        detect_isotopes(
+            int_file_data,
+            peak_file_data,
+            labeling_data,
+            rt_window,
+            ppm,
+            noise_cutoff,
+            alpha,
+            enrich_tol,
+            isotopes_path,
+        )
+
+
+def detect_isotopes(
+    int_file_data: pd.DataFrame,
+    peak_file_data: pd.DataFrame,
+    labeling_data: List[str],
+    rt_window: float,
+    ppm: float,
+    noise_cutoff: float,
+    alpha: float,
+    enrich_tol: float,
+    isotopes_path: str,
 ):
     r_int_data = pandas2ri.py2rpy(int_file_data)
     r_peak_data = pandas2ri.py2rpy(peak_file_data)
@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import pandas as pd
+from app.components.utils import UserInputError, read_upload_table
+from pandas import DataFrame
+from pandas.api.types import is_numeric_dtype
+
+
+@dataclass(frozen=True)
+class TableSchema:
+    """Columns a pipeline table needs and the types they are kept in.
+
+    String keys are kept as categoricals, so groupbys and filters compare
+    integer codes instead of Python strings. The categories keep the parsed
+    values, e.g. integer experiments stay integers. Measurements keep their
+    parsed float64 type, they are fitted, compared against thresholds and
+    written out, where float32 would change the results.
+    """
+
+    name: str
+    required: Tuple[str, ...]
+    categorical: Tuple[str, ...] = ()
+    numeric: Tuple[str, ...] = ()
+
+    def apply(self, df: DataFrame) -> DataFrame:
+        """Validate `df` and convert its key columns in place."""
+        missing = [column for column in self.required if column not in df.columns]
+        if missing:
+            raise UserInputError(f"Missing required columns: {', '.join(missing)}.")
+
+        invalid = [
+            column
+            for column in self.numeric
+            if column in df.columns and not is_numeric_dtype(df[column])
+        ]
+        if invalid:
+            raise UserInputError(
+                f"Columns of the {self.name} must be numeric: {', '.join(invalid)}."
+            )
+
+        for column in self.categorical:
+            if column in df.columns:
+                df[column] = df[column].astype("category")
+        return df
+
+    def read_csv(self, file_path: str) -> DataFrame:
+        return self.apply(pd.read_csv(file_path))
+
+    def read_upload(self, content: bytes, delimiter: Optional[str] = ",") -> DataFrame:
+        return self.apply(read_upload_table(content, delimiter))
+
+
+# MIDs uploaded for the contextualization, as written by the MID calculation
+MID_TABLE = TableSchema(
+    "MID table",
+    required=(
+        "name",
+        "compound_id",
+        "mass_isotopomer",
+        "mids",
+        "cis",
+        "intensity_mean",
+        "intensity_se",
+        "mz",
+        "rt",
+        "experiment",
+        "condition",
+    ),
+    categorical=("name", "experiment", "condition"),
+    numeric=("mids", "cis", "intensity_mean", "intensity_se"),
+)
+
+# Isotopologue report of the isotope detection, one column per sample
+ISOTOPE_REPORT = TableSchema(
+    "isotope report",
+    required=("name", "compound_id", "formula", "compound", "isotopologue", "rt"),
+    categorical=("name", "compound_id", "formula"),
+    numeric=("compound", "isotopologue"),
+)
+
+# Measurements uploaded for the targeted MID calculation
+TARGETED_TABLE = TableSchema(
+    "targeted table",
+    required=(
+        "name",
+        "experiment",
+        "condition",
+        "reference",
+        "mass_isotopomer",
+        "intensity",
+    ),
+    categorical=("name", "experiment", "condition", "reference"),
+    numeric=("intensity",),
+)
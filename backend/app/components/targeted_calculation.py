@@ -208,196 +208,229 @@ def mid_calculation(
     }
 
 
-def fill_missing_measurements(dataframe, ctrl_label="Ctrl"):
-    # Extract the complete structure from the Ctrl sample
-    ctrl_structure = dataframe[dataframe["condition"] == ctrl_label][
-        "mass_isotopomer"
-    ].unique()
-
-    # Create a list to hold the filled data
-    filled_data = []
-
-    # For each unique condition, check and fill missing measurements
-    for sample in dataframe["sample"].unique():
-        subset = dataframe[dataframe["sample"] == sample]
-        present_measurements = subset["mass_isotopomer"].unique()
-        missing_measurements = set(ctrl_structure) - set(present_measurements)
-        # Add present data to the filled_data list
-        filled_data.append(subset)
-
-        # Create rows for missing measurements and add to the filled_data list
-        for missing in missing_measurements:
-            new_row = {
-                "condition": subset["condition"].unique()[0],
-                "mass_isotopomer": missing,
-                "relative_intensity": 0,  # Assuming 0 value for missing data
-                "experiment": subset["experiment"].unique()[0],
-                "sample": sample,
-                "reference": subset["reference"].unique()[0],
-                "name": subset["name"].unique()[0],
-                "replicate": "filled",
-            }
+def fill_missing_measurements(dataframe, ctrl_label="Ctrl", by=None):
+    """Add a zero intensity row for every mass isotopomer of the control
+    samples that a sample misses.
+
+    With `by`, the mass isotopomers of the control samples are taken per
+    group of the `by` columns. The filled rows of a sample follow its
+    measurements and are marked as replicate "filled".
+    """
+    by = list(by) if by else []
+    keys = by + ["sample"]
+    fill_columns = keys + [
+        column
+        for column in ["condition", "experiment", "reference", "name"]
+        if column not in keys
+    ]
 
-            filled_data.append(pd.DataFrame([new_row]))
+    # Extract the complete structure from the Ctrl samples
+    ctrl_structure = dataframe.loc[
+        dataframe["condition"] == ctrl_label, by + ["mass_isotopomer"]
+    ].drop_duplicates()
+
+    # Every sample with the structure of its group, taking the other values
+    # of the filled rows from the first measurement of the sample
+    samples = dataframe.drop_duplicates(keys)[fill_columns]
+    expected = (
+        samples.merge(ctrl_structure, on=by)
+        if by
+        else samples.merge(ctrl_structure, how="cross")
+    )
+    present = pd.MultiIndex.from_frame(dataframe[keys + ["mass_isotopomer"]])
+    missing = expected[
+        ~pd.MultiIndex.from_frame(expected[keys + ["mass_isotopomer"]]).isin(present)
+    ]
+    if missing.empty:
+        return dataframe.reset_index(drop=True)
+
+    # Assuming 0 value for missing data
+    missing = missing.assign(relative_intensity=0, replicate="filled")
+    filled_dataframe = pd.concat([dataframe, missing], ignore_index=True)
+    sample_codes = (
+        filled_dataframe.groupby(keys, sort=False, observed=True).ngroup().to_numpy()
+    )
+    return filled_dataframe.take(np.argsort(sample_codes, kind="stable")).reset_index(
+        drop=True
+    )
+
+
+def correction_matrix(intensity_unlabeled: np.ndarray) -> np.ndarray:
+    """Natural abundance correction matrix of a metabolite.
+
+    The first column is the mean unlabeled MID, column k its M+0 and M+1
+    shifted by k and corrected for the natural 13C abundance of k carbons,
+    followed by the rest of the unlabeled MID.
+    """
+    num_unlabeled = len(intensity_unlabeled)
+    carbon_abu = np.arange(num_unlabeled) * (0.0107 / 0.9893)
+    m1_corr = (intensity_unlabeled[0] * carbon_abu) / (
+        (intensity_unlabeled[1] / intensity_unlabeled[0]) + 1 - carbon_abu
+    )
 
-    # Combine all the data together
-    filled_dataframe = pd.concat(filled_data, ignore_index=True)
+    matrix = np.zeros((num_unlabeled, num_unlabeled))
+    matrix[:, 0] = intensity_unlabeled
+    for index in range(1, num_unlabeled - 1):
+        matrix[index, index] = intensity_unlabeled[0] + m1_corr[index]
+        matrix[index + 1, index] = intensity_unlabeled[1] - m1_corr[index]
+        matrix[index + 2 :, index] = intensity_unlabeled[2 : num_unlabeled - index]
 
-    return filled_dataframe
+    index = num_unlabeled - 1
+    matrix[index, index] = intensity_unlabeled[0] + m1_corr[index]
+    return matrix
 
 
 def calculate_mid(df, ctrl_label="Ctrl"):
-    carbon_abu = lambda intensity: intensity * (0.0107 / 0.9893)
-
     df["sample"] = df["reference"].astype(str) + df["name"].astype(str)
-    metabolite_dict = {}
-    for metabolite in df["name"].unique():
-        df_metabolite = df[df["name"] == metabolite]
-
-        experiment_dict = {}
-        for experiment in df_metabolite["experiment"].unique():
-            df_sub = df_metabolite[df_metabolite["experiment"] == experiment]
-
-            # Calculate the sum of "Area" per group of ["sample", "mass_isotopomer"]
-            df_sub["sum_area"] = df_sub.groupby(["sample", "mass_isotopomer"])[
-                "intensity"
-            ].transform("sum")
-            df_sub = df_sub.drop_duplicates(["sample", "mass_isotopomer"])
-
-            # Calculate the sum of "sum_area" per group of "sample"
-            df_sub["sum_sample_area"] = df_sub.groupby(["sample"])[
-                "sum_area"
-            ].transform("sum")
-
-            # Calculate "relative_intensity" by dividing "sum_area" by "sum_sample_area" for each group of ["sample", "mass_isotopomer"]
-            df_sub["relative_intensity"] = (
-                df_sub.groupby(["sample", "mass_isotopomer"], as_index=False)
-                .apply(lambda x: x["sum_area"] / x["sum_sample_area"])
-                .reset_index(level=0, drop=True)
-            )
-
-            # Extract the number after 'm+' or 'M+' from the "mass_isotopomer" column and convert it to integer
-            df_sub["order"] = df_sub["mass_isotopomer"].str.extract(r"(?i)m\+(\d+)")
-
-            # Check if extraction resulted in NaNs
-            if df_sub["order"].isna().any():
-                raise UserInputError(
-                    "Could not identify Mass Isotopomers. Are they in the correct format M+0 or m+0?"
-                )
-
-            # Convert to integer
-            df_sub["order"] = df_sub["order"].astype(int)
-            # Sort df_sub by the 'order' column
-            df_sub = df_sub.sort_values("order")
-
-            df_sub = fill_missing_measurements(df_sub, ctrl_label=ctrl_label)
-
-            unlabeled = (
-                df_sub[df_sub["condition"].str.contains(ctrl_label)]
-                .groupby("mass_isotopomer", sort=False)["relative_intensity"]
-                .agg(["mean", "std"])
-            )
-
-            intensity_unlabeled = unlabeled["mean"]
-            num_unlabeled = len(intensity_unlabeled)
-            # Initialize the correction matrix with zeros and set the first column to the unlabeled intensities
-            correction_matrix = np.zeros((num_unlabeled, num_unlabeled))
-            correction_matrix[:, 0] = intensity_unlabeled
-
-            # Calculate the rest of the correction matrix
-            for index in range(1, num_unlabeled - 1):
-                m1_corr = (intensity_unlabeled[0] * carbon_abu(index)) / (
-                    (intensity_unlabeled[1] / intensity_unlabeled[0])
-                    + 1
-                    - carbon_abu(index)
-                )
-                m_a_0 = intensity_unlabeled[0] + m1_corr
-                m_a_1 = intensity_unlabeled[1] - m1_corr
-                intensity_new = [0] * index + [m_a_0, m_a_1]
-                if index != (num_unlabeled - 2):
-                    fill_rest = num_unlabeled - len(intensity_new)
-                    intensity_new += list(intensity_unlabeled[2 : 2 + fill_rest])
-                correction_matrix[:, index] = intensity_new
-
-            index = num_unlabeled - 1
-            m_a_0 = intensity_unlabeled[0] + (
-                (intensity_unlabeled[0] * carbon_abu(index))
-                / (
-                    (intensity_unlabeled[1] / intensity_unlabeled[0])
-                    + 1
-                    - carbon_abu(index)
-                )
-            )
 
-            intensity_new = [0] * index + [m_a_0]
-            correction_matrix[:, index] = intensity_new
-
-            # Calculate corrected values for each sample using the correction matrix
-            df_mids = (
-                df_sub[~df_sub["condition"].str.contains(ctrl_label)]
-                .groupby(["sample"])
-                .apply(
-                    lambda x: np.dot(
-                        np.linalg.inv(correction_matrix), x.relative_intensity
-                    )
-                )
-            )
-
-            # Create a DataFrame from the corrected values and melt it
-            df_mids = pd.DataFrame(
-                df_mids.tolist(),
-                columns=[f"M+{index}" for index in range(num_unlabeled)],
-                index=df_mids.index,
-            )
-            df_mids["sample"] = df_mids.index
-
-            df_mids = pd.melt(
-                df_mids,
-                value_vars=[f"M+{index}" for index in range(num_unlabeled)],
-                id_vars=["sample"],
+    # Sum the intensities of every sample and mass isotopomer and take their
+    # share of the sample, for all metabolites and experiments at once
+    keys = ["name", "experiment", "sample", "mass_isotopomer"]
+    data = df.assign(
+        sum_area=df.groupby(keys, observed=True)["intensity"].transform("sum")
+    )
+    data = data.drop_duplicates(keys)
+    data["relative_intensity"] = data["sum_area"] / data.groupby(
+        keys[:3], observed=True
+    )["sum_area"].transform("sum")
+
+    # Extract the number after 'm+' or 'M+' from the "mass_isotopomer" column
+    data["order"] = data["mass_isotopomer"].str.extract(r"(?i)m\+(\d+)", expand=False)
+
+    # Check if extraction resulted in NaNs
+    if data["order"].isna().any():
+        raise UserInputError(
+            "Could not identify Mass Isotopomers. Are they in the correct format M+0 or m+0?"
+        )
+    data["order"] = data["order"].astype(int)
+
+    grouped = data.groupby(["name", "experiment"], sort=False, observed=True)
+    data["group"] = grouped.ngroup()
+    data = data[data["group"] >= 0]
+    if data.empty:
+        return {}
+    data = data.take(np.argsort(data["group"].to_numpy(), kind="stable"))
+    groups = list(
+        data.drop_duplicates("group")[["name", "experiment"]].itertuples(
+            index=False, name=None
+        )
+    )
+
+    # Sort every metabolite and experiment by mass isotopomer, with the
+    # quicksort of sort_values, and fill in the mass isotopomers its samples
+    # miss
+    bounds = np.searchsorted(data["group"].to_numpy(), np.arange(len(groups) + 1))
+    order = data["order"].to_numpy()
+    data = data.take(
+        np.concatenate(
+            [
+                start + np.argsort(order[start:stop], kind="quicksort")
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ]
+        )
+    )
+    data = fill_missing_measurements(data, ctrl_label=ctrl_label, by=["group"])
+
+    control = data["condition"].str.contains(ctrl_label).to_numpy(dtype=bool)
+
+    # Mean unlabeled MID of every group, in the order its mass isotopomers
+    # appear in the control samples
+    unlabeled = (
+        data[control]
+        .groupby(["group", "mass_isotopomer"], sort=False)["relative_intensity"]
+        .mean()
+    )
+    unlabeled_bounds = np.searchsorted(
+        unlabeled.index.get_level_values("group"), np.arange(len(groups) + 1)
+    )
+    unlabeled = unlabeled.to_numpy()
+
+    data["mass_isotopomer"] = data["mass_isotopomer"].str.capitalize()
+    group_codes = data["group"].to_numpy()
+    sample_codes, _ = pd.factorize(data["sample"])
+    relative_intensity = data["relative_intensity"].to_numpy(dtype=float)
+    # k of the rows labeled M+k like the corrected MIDs, -1 for other labels
+    variable_order = (
+        data["mass_isotopomer"]
+        .str.extract(r"^M\+(0|[1-9][0-9]*)$", expand=False)
+        .fillna(-1)
+        .astype(int)
+        .to_numpy()
+    )
+
+    bounds = np.searchsorted(group_codes, np.arange(len(groups) + 1))
+    value = np.full(len(data), np.nan)
+    for code in range(len(groups)):
+        start, stop = bounds[code], bounds[code + 1]
+        matrix = correction_matrix(
+            unlabeled[unlabeled_bounds[code] : unlabeled_bounds[code + 1]]
+        )
+        num_unlabeled = len(matrix)
+
+        # Correct all labeled samples of the group with a single solve, every
+        # sample has one relative intensity per row of the matrix
+        labeled = start + np.flatnonzero(~control[start:stop])
+        samples, sample_index = np.unique(sample_codes[labeled], return_inverse=True)
+        if not len(samples):
+            continue
+        if np.any(np.bincount(sample_index) != num_unlabeled):
+            raise ValueError(
+                f"Every sample needs {num_unlabeled} mass isotopomers to be corrected"
             )
+        rows = labeled[np.argsort(sample_index, kind="stable")]
+        mids = np.linalg.solve(
+            matrix, relative_intensity[rows].reshape(len(samples), -1).T
+        )
 
-            df_sub["mass_isotopomer"] = df_sub["mass_isotopomer"].str.capitalize()
-            df_mids["variable"] = df_mids["variable"].str.capitalize()
-
-            # Merge the melted DataFrame with the original DataFrame
-            df_mids = pd.merge(
-                df_sub,
-                df_mids,
-                how="left",
-                right_on=["sample", "variable"],
-                left_on=["sample", "mass_isotopomer"],
-            )
+        # Every row of a corrected sample labeled M+k gets its k-th MID
+        positions = np.arange(start, stop)
+        column = np.searchsorted(samples, sample_codes[start:stop])
+        column[column == len(samples)] = 0
+        hits = (samples[column] == sample_codes[start:stop]) & (
+            (variable_order[start:stop] >= 0)
+            & (variable_order[start:stop] < num_unlabeled)
+        )
+        value[positions[hits]] = mids[variable_order[start:stop][hits], column[hits]]
+        variable_order[positions[~hits]] = -1
+
+    is_corrected = variable_order >= 0
+    corrected = data.loc[is_corrected, ["group", "condition"]]
+    corrected["isotopomer"] = data["mass_isotopomer"][is_corrected]
+    corrected["value"] = value[is_corrected]
+    grouped = (
+        corrected.groupby(["group", "condition", "isotopomer"], observed=True)["value"]
+        .agg(["mean", "std"])
+        .reset_index()
+    )
+    grouped = grouped[grouped["condition"] != ctrl_label]
+    grouped["order"] = (
+        grouped["isotopomer"].str.extract(r"(?i)m\+(\d+)", expand=False).astype(int)
+    )
 
-            grouped = (
-                df_mids.groupby(["condition", "variable"])["value"]
-                .agg(["mean", "std"])
-                .reset_index()
+    metabolite_dict = {}
+    bounds = np.searchsorted(grouped["group"].to_numpy(), np.arange(len(groups) + 1))
+    for code, (metabolite, experiment) in enumerate(groups):
+        data = grouped.iloc[bounds[code] : bounds[code + 1]]
+        data = data.sort_values("order")
+
+        if isinstance(experiment, (int, np.int64, np.int32)):
+            experiment = str(experiment)
+
+        metabolite_dict.setdefault(metabolite, {})[experiment] = [
+            {
+                "condition": condition,
+                "isotopomer": isotopomer,
+                "mean": mean,
+                "std": std,
+                "metabolite": metabolite,
+                "experiment": experiment,
+            }
+            for condition, isotopomer, mean, std in zip(
+                data["condition"].tolist(),
+                data["isotopomer"].tolist(),
+                data["mean"].tolist(),
+                data["std"].tolist(),
             )
-
-            # Select relevant columns for the final data
-            data = grouped.loc[
-                (grouped["condition"] != ctrl_label) & (~grouped["condition"].isnull()),
-                ["condition", "variable", "mean", "std"],
-            ]
-
-            # Replace "mass_isotopomer" with "isotopomer" in the final data
-            data.rename(columns={"variable": "isotopomer"}, inplace=True)
-
-            if isinstance(experiment, (int, np.int64, np.int32)):
-                experiment = str(experiment)
-
-            data["metabolite"] = metabolite
-            data["experiment"] = experiment
-
-            data["order"] = data["isotopomer"].str.extract(r"(?i)m\+(\d+)")
-            data["order"] = data["order"].astype(int)
-            data = data.sort_values("order")
-            data = data.drop(columns=["order"])
-
-            data_dict = data.to_dict(orient="records")
-            
-            experiment_dict[experiment] = data_dict
-        metabolite_dict[metabolite] = experiment_dict
+        ]
 
     return metabolite_dict
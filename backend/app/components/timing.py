@@ -0,0 +1,83 @@
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TIMINGS_FILE = "timings.json"
+
+
+def timed_call(function: Callable, *args) -> Tuple[Any, float]:
+    """Call `function` and return its result with the CPU time spent on it.
+
+    Pool tasks are wrapped in it, so the CPU time of the workers can be
+    added to the span of the job as `worker_cpu_time`.
+    """
+    start = time.process_time()
+    result = function(*args)
+    return result, time.process_time() - start
+
+
+class Timings:
+    """Wall time, CPU time and item counts of the stages of a pipeline job.
+
+    Every finished span is logged and, given a manager and session, sent to
+    the client as a timing event. `write` stores all spans of the job in the
+    timings.json of the session directory, next to the spans of the other
+    jobs of the session.
+
+    CPU time covers the process running the job. Stages that run in the
+    pool add the CPU time their workers report to `worker_cpu_time` of the
+    span record, which is counted into the CPU time of the span.
+    """
+
+    def __init__(self, job: str, manager=None, session_id: Optional[str] = None):
+        self.job = job
+        self.manager = manager
+        self.session_id = session_id
+        self.spans: List[Dict] = []
+
+    @contextlib.contextmanager
+    def span(self, stage: str, items: Optional[int] = None) -> Iterator[Dict]:
+        """Time the enclosed block as `stage`. The yielded record can be used
+        to set `items` once the count is known and to add `worker_cpu_time`."""
+        record = {"job": self.job, "stage": stage, "items": items}
+        record["worker_cpu_time"] = 0.0
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            worker_cpu_time = record.pop("worker_cpu_time")
+            cpu_time = time.process_time() - start_cpu + worker_cpu_time
+            record["wall_time"] = round(time.perf_counter() - start_wall, 6)
+            record["cpu_time"] = round(cpu_time, 6)
+            self.spans.append(record)
+            logger.info(
+                f"{self.job} {stage}: {record['wall_time']:.3f}s wall, "
+                f"{record['cpu_time']:.3f}s cpu, {record['items']} items"
+            )
+            if self.manager and self.session_id:
+                self.manager.send_timing(self.session_id, record)
+
+    def write(self, session_dir: str):
+        """Store the spans of this job in the timings.json of `session_dir`,
+        replacing those of an earlier run of the same job."""
+        path = os.path.join(session_dir, TIMINGS_FILE)
+        timings = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    timings = json.load(file)
+            except ValueError:
+                timings = {}
+        timings[self.job] = self.spans
+
+        os.makedirs(session_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(timings, file, indent=2)
+        os.replace(tmp_path, path)
@@ -1,28 +1,105 @@
+import codecs
+import csv
 import io
 import os
+from typing import Optional
 
 import chardet
 import pandas as pd
+from app.components.compute_executor import compute_executor
 from fastapi import HTTPException, UploadFile, status
 from pandas import DataFrame
 
+# Encodings are detected on this many leading bytes of an upload
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# Delimiters are sniffed on this many leading characters
+DELIMITER_SAMPLE_SIZE = 2000
+
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
 
 async def process_csv_file(file: UploadFile) -> DataFrame:
     content = await file.read()
+    return await compute_executor.run(read_upload_table, content)
+
 
-    detected_encoding = chardet.detect(content)
-    file_encoding = detected_encoding["encoding"]
+def detect_encoding(
+    content: bytes, sample_size: Optional[int] = ENCODING_SAMPLE_SIZE
+) -> str:
+    """Encoding of an upload from its byte order mark, else UTF-8 if its
+    first `sample_size` bytes decode as such, else as detected by chardet on
+    them. With `sample_size=None` the whole upload is used.
 
-    if file_encoding is None:
+    Empty uploads and samples that do not decode with the detected encoding
+    are rejected with a 422."""
+    if not content:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail="Unable to detect file encoding.",
+            detail="The uploaded file is empty.",
         )
 
-    decoded_contents = content.decode(file_encoding)
-    content_io = io.StringIO(decoded_contents)
+    for bom, encoding in BOM_ENCODINGS:
+        if content.startswith(bom):
+            return encoding
+
+    sample = content[:sample_size] if sample_size else content
+    try:
+        # A character cut off at the end of the sample is no error
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    file_encoding = chardet.detect(sample)["encoding"]
+    if file_encoding is not None:
+        try:
+            codecs.getincrementaldecoder(file_encoding)().decode(sample, final=False)
+            return file_encoding
+        except (LookupError, UnicodeDecodeError):
+            pass
+
+    raise HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="Unable to detect file encoding.",
+    )
 
-    return pd.read_csv(content_io)
+
+def decode_upload(content: bytes) -> str:
+    try:
+        return content.decode(detect_encoding(content))
+    except UnicodeDecodeError:
+        # The sample was not representative, detect on the whole upload
+        return content.decode(detect_encoding(content, None))
+
+
+def read_upload_table(content: bytes, delimiter: Optional[str] = ",") -> DataFrame:
+    """Parse an uploaded table straight from its bytes.
+
+    The encoding is detected on a bounded sample. With `delimiter=None`, the
+    delimiter is sniffed on the decoded start of the same sample.
+    """
+    file_encoding = detect_encoding(content)
+    if delimiter is None:
+        decoder = codecs.getincrementaldecoder(file_encoding)(errors="replace")
+        sample = decoder.decode(content[:ENCODING_SAMPLE_SIZE])
+        delimiter = csv.Sniffer().sniff(sample[:DELIMITER_SAMPLE_SIZE]).delimiter
+
+    try:
+        return pd.read_csv(io.BytesIO(content), sep=delimiter, encoding=file_encoding)
+    except UnicodeDecodeError:
+        # The sample was not representative, parse the table with the
+        # encoding of the whole upload
+        return pd.read_csv(
+            io.BytesIO(content),
+            sep=delimiter,
+            encoding=detect_encoding(content, None),
+        )
 
 
 def read_csv_file(file_path: str) -> DataFrame:
@@ -0,0 +1,76 @@
+import contextlib
+import logging
+import multiprocessing
+import threading
+from multiprocessing.pool import Pool
+from typing import Iterator, Optional
+
+from app.components.aligner import MIDAligner
+
+logger = logging.getLogger(__name__)
+
+
+def warm_worker(mc_table_dir: Optional[str]):
+    """Initializer of the pool workers.
+
+    Imports the numerical kernels of the pool tasks once per worker, so tasks
+    start without import overhead. These do not import the upload helpers,
+    FastAPI or rpy2.
+    """
+    import app.components.mid_fitting  # noqa: F401
+    import app.components.network  # noqa: F401
+
+    MIDAligner.set_mc_table_dir(mc_table_dir)
+
+
+class WorkerPool:
+    """Application scoped pool of warm worker processes.
+
+    The pool is started once and shared by all compute jobs. Without a
+    started pool, e.g. in scripts and tests, `acquire` falls back to a
+    temporary pool for the duration of a job.
+    """
+
+    def __init__(self):
+        self.pool: Optional[Pool] = None
+        self.processes = 0
+        self.lock = threading.Lock()
+
+    def start(self, processes: int, mc_table_dir: Optional[str] = None):
+        with self.lock:
+            if self.pool is not None:
+                return
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                processes=processes,
+                initializer=warm_worker,
+                initargs=(mc_table_dir,),
+            )
+            self.processes = processes
+            logger.info(f"Started worker pool with {processes} processes")
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is None:
+                return
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.processes = 0
+
+    @contextlib.contextmanager
+    def acquire(self, processes: int) -> Iterator[Pool]:
+        """The running application pool, or a temporary pool of `processes`
+        workers if none was started."""
+        if self.pool is not None:
+            yield self.pool
+            return
+
+        with multiprocessing.get_context("spawn").Pool(
+            processes=processes,
+            initializer=warm_worker,
+            initargs=(MIDAligner.mc_table_dir,),
+        ) as pool:
+            yield pool
+
+
+worker_pool = WorkerPool()
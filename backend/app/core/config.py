@@ -44,6 +44,15 @@ class Settings(BaseSettings):
     PROJECT_NAME: str = "IMPACT Backend"
     MULTI_CORE: bool = True
 
+    # Directory of the persistent Monte Carlo null model tables
+    MC_TABLE_DIR: str = "../cache/monte_carlo"
+    # Null models up to this MID length are estimated at startup
+    MC_WARM_LENGTH: int = 16
+    # Also write a gzip compressed network_graph.json.gz
+    CONTEXT_COMPRESSED: bool = False
+    # Threads for parsing uploads and calculations requests wait for
+    COMPUTE_THREADS: int = 4
+
     class Config:
         case_sensitive = True
 
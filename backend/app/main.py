@@ -5,6 +5,9 @@ import shutil
 import time
 
 from app.api.api import api_router
+from app.components.aligner import MIDAligner
+from app.components.compute_executor import compute_executor
+from app.components.worker_pool import worker_pool
 from app.core.config import settings
 from app.manager import manager
 from fastapi import FastAPI, Request
@@ -66,3 +69,36 @@ async def start_remove_expired_sessions_task():
         logging.info(f"Created uploads directory at {UPLOADS_DIR}")
 
     asyncio.create_task(remove_expired_sessions())
+
+
+@app.on_event("startup")
+async def warm_monte_carlo_models():
+    MIDAligner.set_mc_table_dir(settings.MC_TABLE_DIR)
+
+    # Estimate the null models of common MID lengths without blocking startup
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(None, MIDAligner.warm_mc_table, settings.MC_WARM_LENGTH)
+
+
+@app.on_event("startup")
+async def start_worker_pool():
+    # Warm workers shared by all compute jobs, they import the numerical
+    # kernels once instead of on every job
+    worker_pool.start(settings.CORE_COUNT, settings.MC_TABLE_DIR)
+
+
+@app.on_event("startup")
+async def start_compute_executor():
+    # Bounded threads for the CPU heavy steps of request handlers, which
+    # would otherwise block the event loop
+    compute_executor.start(settings.COMPUTE_THREADS)
+
+
+@app.on_event("shutdown")
+async def stop_worker_pool():
+    worker_pool.shutdown()
+
+
+@app.on_event("shutdown")
+async def stop_compute_executor():
+    compute_executor.shutdown()
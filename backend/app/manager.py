@@ -1,7 +1,8 @@
 import asyncio
+import json
 import os
 from datetime import datetime
-from typing import Dict, List, Set
+from typing import Any, Dict, List, Set
 
 import redis
 from fastapi import WebSocket
@@ -62,6 +63,15 @@ class ConnectionManager:
             asyncio.set_event_loop(loop)
             loop.run_until_complete(websocket.send_text(formatted_message))
 
+    def send_timing(self, session_id: str, timing: Dict[str, Any]):
+        self.redis_client.rpush(f"timings:{session_id}", json.dumps(timing))
+
+        websocket = self.active_connections.get(session_id)
+        if websocket:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(websocket.send_json({"timing": timing}))
+
     def update_session_object(self, session_id: str, key: str, value: str):
         self.redis_client.hset(f"session:{session_id}", key, value)
         self.send_session_object(session_id)
@@ -86,6 +96,7 @@ class ConnectionManager:
         self.redis_client.srem("initiated_sessions", session_id)
         self.redis_client.delete(f"history:{session_id}")
         self.redis_client.delete(f"session:{session_id}")
+        self.redis_client.delete(f"timings:{session_id}")
 
 
 manager = ConnectionManager()
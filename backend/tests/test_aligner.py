@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pytest
+from app.components.aligner import MIDAligner
+
+
+def test_align_vectors():
+    v1, v2, distance = MIDAligner.align_vectors([0.1, 0.2, 0.7], [0.7, 0.3], 0.2)
+
+    assert v1 == pytest.approx([0.1, 0.2, 0.7])
+    assert v2 == pytest.approx([0.0, 0.7, 0.3])
+    assert distance == pytest.approx(0.1296148139681572)
+
+
+def test_align_vectors_empty():
+    with pytest.raises(Exception):
+        MIDAligner.align_vectors([], [0.5, 0.5], 0.2)
+
+
+def test_align_many_matches_align_vectors():
+    rng = np.random.default_rng(0)
+    mids1 = [rng.random(rng.integers(1, 10)) for _ in range(50)]
+    mids2 = [rng.random(rng.integers(1, 10)) for _ in range(50)]
+
+    padded1, lengths1 = MIDAligner.stack_mids(mids1)
+    padded2, lengths2 = MIDAligner.stack_mids(mids2)
+    r_mids1, r_mids2, lengths, distances = MIDAligner.align_many(
+        padded1, padded2, 0.2, lengths1, lengths2
+    )
+
+    for i, (mid1, mid2) in enumerate(zip(mids1, mids2)):
+        v1, v2, distance = MIDAligner.align_vectors(mid1, mid2, 0.2)
+        assert lengths[i] == len(v1)
+        assert r_mids1[i, : lengths[i]] == pytest.approx(v1)
+        assert r_mids2[i, : lengths[i]] == pytest.approx(v2)
+        assert distances[i] == pytest.approx(distance)
+
+
+def test_align_many_abandons_pairs():
+    rng = np.random.default_rng(1)
+    mids1 = [rng.dirichlet(np.ones(rng.integers(1, 10))) for _ in range(200)]
+    mids2 = [rng.dirichlet(np.ones(rng.integers(1, 10))) for _ in range(200)]
+    mids1[0][0] = np.nan
+    padded1, lengths1 = MIDAligner.stack_mids(mids1)
+    padded2, lengths2 = MIDAligner.stack_mids(mids2)
+
+    _, _, _, distances = MIDAligner.align_many(
+        padded1, padded2, 0.2, lengths1, lengths2
+    )
+    assert (
+        MIDAligner.distance_bounds(padded1, padded2, lengths1, lengths2)
+        <= distances
+    ).all()
+
+    max_distances = MIDAligner.max_distances(lengths1, lengths2)
+    r_mids1, _, lengths, bounded = MIDAligner.align_many(
+        padded1, padded2, 0.2, lengths1, lengths2, max_distances
+    )
+
+    abandoned = np.isinf(bounded)
+    assert abandoned.any()
+    assert (distances[abandoned] > max_distances[abandoned]).all()
+    assert (bounded[~abandoned] == distances[~abandoned]).all()
+    assert (lengths[abandoned] == 0).all() and (r_mids1[abandoned] == 0).all()
+
+    # Every pair abandoned
+    _, _, _, bounded = MIDAligner.align_many(
+        padded1, padded2, 0.2, lengths1, lengths2, np.zeros(len(mids1)) - 1
+    )
+    assert np.isinf(bounded).all()
+
+
+def test_monte_carlo_table_is_persisted(tmp_path):
+    MIDAligner.clear_cache()
+    MIDAligner.set_mc_table_dir(str(tmp_path))
+    try:
+        mc = MIDAligner.get_monte_carlo_model(5, 3, 0.2)
+
+        # A fresh process only sees the table on disk
+        MIDAligner.clear_cache()
+        MIDAligner.set_mc_table_dir(str(tmp_path))
+        table = MIDAligner.get_mc_table(0.2)
+
+        assert table[3, 5, 0] == mc.mean_distance
+        assert table[3, 5, 1] == mc.sd_distance
+        assert MIDAligner.get_monte_carlo_model(3, 5, 0.2).mean_distance == (
+            mc.mean_distance
+        )
+        assert (3, 5, 0.4) not in MIDAligner.mc_models
+    finally:
+        MIDAligner.clear_cache()
+        MIDAligner.set_mc_table_dir(None)
+
+
+def test_monte_carlo_table_keeps_published_table(tmp_path, monkeypatch):
+    MIDAligner.clear_cache()
+    MIDAligner.set_mc_table_dir(str(tmp_path))
+    try:
+        mc = MIDAligner.get_monte_carlo_model(2, 4, 0.2)
+
+        # A worker that lost the race to create the table uses the published one
+        MIDAligner.clear_cache()
+        monkeypatch.setattr(os.path, "exists", lambda path: False)
+        table = MIDAligner.get_mc_table(0.2)
+
+        assert table[2, 4, 0] == mc.mean_distance
+        assert sorted(path.name for path in tmp_path.iterdir()) == ["mc_gap_0.2.npy"]
+    finally:
+        monkeypatch.undo()
+        MIDAligner.clear_cache()
+        MIDAligner.set_mc_table_dir(None)
+
+
+def test_monte_carlo_model_is_reproducible():
+    mc = MIDAligner.estimate_monte_carlo_model(3, 5, 0.2)
+
+    assert MIDAligner.estimate_monte_carlo_model(3, 5, 0.2).mean_distance == (
+        mc.mean_distance
+    )
+    assert MIDAligner.estimate_monte_carlo_model(3, 5, 0.4).mean_distance != (
+        mc.mean_distance
+    )
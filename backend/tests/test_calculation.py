@@ -0,0 +1,263 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.components.calculation import (
+    clean_data,
+    run_mid_calculation,
+    run_mid_sweep,
+    sweep_file_name,
+)
+from app.components.mid_fit_cache import MIDFitCache
+from app.components.mid_fitting import (
+    MID_COLUMNS,
+    fit_mid,
+    mid_design_matrix,
+    process_isotopes,
+    solve_mid_fits,
+)
+
+
+def write_isotopes(path):
+    pd.DataFrame(
+        {
+            "": [1, None, None, None, 2, None, None],
+            "name": ["Pyruvate", None, None, None, "Water", None, None],
+            "compound_id": ["C00022", None, None, None, None, None, None],
+            "formula": ["C3H4O3", None, None, None, "H2O", None, None],
+            "compound": [87.0088, None, None, None, 17.0027, None, None],
+            "isotopologue": [
+                87.0088,
+                88.0122,
+                89.0155,
+                91.0222,
+                17.0027,
+                18.0061,
+                18.5078,
+            ],
+            "rt": [5.1, 5.1, 5.1, 5.1, 1.2, 1.2, 1.2],
+            "s1": [100.0, 20.0, 5.0, 1.0, 50.0, 2.0, 1.0],
+        }
+    ).to_csv(path, index=False)
+
+
+def test_clean_data(tmp_path):
+    path = tmp_path / "isotopes.csv"
+    write_isotopes(path)
+
+    data = clean_data(path, False)
+
+    assert list(data["id"]) == [2, 2, 2, 1, 1, 1, 1]
+    assert list(data["compound_id"]) == ["", "", "", "C00022"] + ["C00022"] * 3
+    assert list(data["mass_isotopomer"]) == [0, 1, 2, 0, 1, 2, 4]
+
+
+def test_clean_data_formula_trail(tmp_path):
+    path = tmp_path / "isotopes.csv"
+    write_isotopes(path)
+
+    data = clean_data(path, True)
+
+    # Pyruvate has three carbons, water none
+    assert list(data["name"]) == ["Pyruvate"] * 3
+    assert list(data["mass_isotopomer"]) == [0, 1, 2]
+
+
+def test_solve_mid_fits_matches_fit_mid():
+    rng = np.random.default_rng(0)
+    problems = []
+    for _ in range(100):
+        cols = rng.integers(2, 8)
+        unlabeled = rng.dirichlet(np.ones(cols), rng.integers(1, 4))
+        unlabeled[:, 0] += 1
+        unlabeled /= unlabeled.sum(axis=1, keepdims=True)
+        labeled = rng.dirichlet(np.ones(cols), rng.integers(2, 4))
+        problems.append(mid_design_matrix(unlabeled, labeled))
+
+    for problem, (c, r2, cis) in zip(problems, solve_mid_fits(problems)):
+        expected_c, expected_r2, expected_cis = fit_mid(*problem)
+
+        assert c == pytest.approx(expected_c)
+        assert r2 == pytest.approx(expected_r2)
+        assert cis == pytest.approx(expected_cis)
+
+
+def isotope_intensities(relative, mapping):
+    """Relative intensities of one compound, the values of every condition
+    are its M+0 and M+2."""
+    return pd.DataFrame(
+        [
+            {
+                "id": 1,
+                "name": "Pyruvate",
+                "compound_id": "C00022",
+                "formula": "C3H4O3",
+                "compound": 87.0088,
+                "rt": 5.0 + mass_isotopomer,
+                "mass_isotopomer": mass_isotopomer,
+                "condition": condition,
+                "intensity": value * 100,
+                "total_intensity": 100.0,
+                "relative_intensity": value,
+                "timepoint": mapping[condition],
+                "intensity_mean": value * 100,
+                "intensity_se": 1.0,
+            }
+            for condition, values in relative.items()
+            for mass_isotopomer, value in zip([0, 2], values)
+        ]
+    )
+
+
+def test_process_isotopes():
+    mapping = {"c1": "Ctrl", "c2": "Ctrl", "l1": "T1", "l2": "T1"}
+    relative = {
+        "c1": [0.9, 0.1],
+        "c2": [0.91, 0.09],
+        "l1": [0.5, 0.5],
+        "l2": [0.5, 0.5],
+    }
+    relative_intensities = isotope_intensities(relative, mapping)
+
+    data = process_isotopes(relative_intensities, mapping, 0.05, 0, 0.5, 0.8)
+
+    assert list(data.columns) == MID_COLUMNS
+    assert list(data["condition"]) == ["T1"] * 3
+    # The missing M+1 is filled in with zero intensity
+    assert list(data["mass_isotopomer"]) == [0, 1, 2]
+    assert list(data["intensity_mean"]) == [50.0, 0.0, 50.0]
+    assert list(data["rt"]) == [5.0] * 3
+    assert data["mids"].sum() == pytest.approx(1, abs=0.05)
+    assert data["r2"].notna().all()
+
+
+@pytest.mark.parametrize(
+    "relative, min_fraction, max_label, error",
+    [
+        ({"l1": [0.5, 0.5]}, 0.5, 0.8, "no unlabeled condition$"),
+        (
+            {"c1": [0.9, 0.1], "c2": [0.9, 0.1], "l1": [np.nan, 0.5]},
+            0,
+            0.8,
+            "no condition of T1 is free of NaN values",
+        ),
+        (
+            {"c1": [np.nan, 0.1], "c2": [np.nan, 0.1], "l1": [0.5, 0.5]},
+            0,
+            0.8,
+            "no unlabeled condition is free of NaN values and passes max_label",
+        ),
+        (
+            {"c1": [0.0, 1.0], "c2": [0.0, 1.0], "l1": [0.5, 0.5]},
+            0.5,
+            1,
+            "unlabeled M\\+0 is zero",
+        ),
+        (
+            {"c1": [0.9, 0.1], "c2": [0.9, 0.1], "l1": [0.5], "l2": [0.5, 0.5]},
+            0.5,
+            0.8,
+            "the conditions of T1 do not have the 3 mass isotopomers",
+        ),
+        (
+            {"c1": [0.9, 0.1], "l1": [0.5, 0.5]},
+            0.5,
+            0.8,
+            "no labeled timepoint can be fitted",
+        ),
+    ],
+)
+def test_process_isotopes_errors(relative, min_fraction, max_label, error):
+    mapping = {
+        condition: "Ctrl" if condition.startswith("c") else "T1"
+        for condition in relative
+    }
+    relative_intensities = isotope_intensities(relative, mapping)
+
+    with pytest.raises(ValueError, match=f"^Compound 1: {error}"):
+        process_isotopes(
+            relative_intensities, mapping, 0.05, 0, min_fraction, max_label
+        )
+
+
+def test_mid_fit_cache(tmp_path):
+    problem = mid_design_matrix(
+        np.array([[0.9, 0.1, 0.0]]), np.array([[0.5, 0.3, 0.2], [0.6, 0.2, 0.2]])
+    )
+    other = (problem[0], problem[1] + 0.01)
+    key = MIDFitCache.problem_key(*problem)
+    fit = fit_mid(*problem)
+
+    assert key == MIDFitCache.problem_key(problem[0].copy(), problem[1].copy())
+    assert key != MIDFitCache.problem_key(*other)
+
+    MIDFitCache.empty().save(str(tmp_path), [key], [fit])
+    cache = MIDFitCache.open(str(tmp_path))
+    fits = cache.lookup([key, MIDFitCache.problem_key(*other)])
+
+    assert len(cache) == 1
+    assert len(fits) == 2
+    assert fits[1] is None
+    for part, expected in zip(fits[0], fit):
+        assert np.ravel(part) == pytest.approx(np.ravel(expected))
+
+
+class SilentManager:
+    def send_message(self, session_id, message):
+        pass
+
+
+def test_run_mid_sweep_matches_calculation(tmp_path):
+    path = tmp_path / "isotopes.csv"
+    pd.DataFrame(
+        {
+            "": [1, None, None, None, 2, None, None],
+            "name": ["Pyruvate", None, None, None, "Lactate", None, None],
+            "compound_id": ["C00022", None, None, None, "C00186", None, None],
+            "formula": ["C3H4O3", None, None, None, "C3H6O3", None, None],
+            "compound": [87.0088, None, None, None, 89.0244, None, None],
+            "isotopologue": [87.0088, 88.0122, 89.0155, 90.0189]
+            + [89.0244, 90.0278, 91.0311],
+            "rt": [5.1, 5.1, 5.1, 5.1, 4.2, 4.2, 4.2],
+            "c1": [90.0, 8.0, 1.5, 0.5, 95.0, 4.0, 1.0],
+            "c2": [91.0, 7.0, 1.5, 0.5, 94.0, 5.0, 1.0],
+            "l1": [50.0, 10.0, 25.0, 15.0, 80.0, 6.0, 14.0],
+            "l2": [48.0, 12.0, 24.0, 16.0, 82.0, 5.0, 13.0],
+        }
+    ).to_csv(path, index=False)
+    reference_data = pd.DataFrame(
+        {
+            "experiment": ["E1"] * 4,
+            "file_name": ["c1", "c2", "l1", "l2"],
+            "condition": ["Ctrl", "Ctrl", "T1", "T1"],
+        }
+    )
+    grid = [(0.05, 0, 0.5, 0.8), (0.3, 0.3, 0.2, 0.9)]
+    sweep_dir = tmp_path / "sweep"
+
+    results = []
+    for k, thresholds in enumerate(grid):
+        session_dir = tmp_path / f"session{k}"
+        session_dir.mkdir()
+        run_mid_calculation(
+            str(path),
+            reference_data,
+            str(session_dir),
+            *thresholds,
+            False,
+            1,
+            SilentManager(),
+            "session",
+            sweep_dir=str(sweep_dir),
+        )
+        results.append(pd.read_csv(session_dir / "mid.csv"))
+
+    summary = run_mid_sweep(str(sweep_dir), grid, 1, SilentManager(), "session")
+
+    for thresholds, row, expected in zip(grid, summary, results):
+        assert row["error"] == ""
+        sweep = pd.read_csv(sweep_dir / sweep_file_name(*thresholds))
+        pd.testing.assert_frame_equal(sweep, expected)
+    # Lactate is not labeled enough for the second thresholds
+    assert results[0]["mids"].notna().all()
+    assert results[1].loc[results[1]["name"] == "Lactate", "mids"].isna().all()
+    assert [row["passed"] for row in summary] == [2, 1]
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+import pytest
+from app.components.compute_executor import ComputeExecutor
+
+
+def test_run_keeps_event_loop_responsive():
+    executor = ComputeExecutor()
+    executor.start(2)
+
+    async def main():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        result = await executor.run(lambda x: time.sleep(0.2) or x * 2, 21)
+        ticker.cancel()
+        return result, ticks
+
+    try:
+        result, ticks = asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+    assert result == 42
+    assert ticks > 5
+
+
+def test_run_raises_errors():
+    executor = ComputeExecutor()
+
+    def fail():
+        raise ValueError("invalid table")
+
+    try:
+        with pytest.raises(ValueError, match="invalid table"):
+            asyncio.run(executor.run(fail))
+    finally:
+        executor.shutdown()
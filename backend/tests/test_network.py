@@ -0,0 +1,322 @@
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from app.components.connection_store import SCORE_DTYPE, ConnectionStore
+from app.components.mid_index import MIDIndex
+from app.components.network import (
+    CONNECTION_DTYPE,
+    Network,
+    NetworkElement,
+    connection_edges,
+)
+
+
+def mid_table(mids):
+    """Build a MID table from {(name, experiment, condition): [mids]}."""
+    rows = []
+    for n, ((name, experiment, condition), values) in enumerate(mids.items()):
+        for isotopomer, value in enumerate(values):
+            rows.append(
+                {
+                    "name": name,
+                    "compound_id": float(n),
+                    "mass_isotopomer": f"M+{isotopomer}",
+                    "mids": value,
+                    "cis": 0.01,
+                    "intensity_mean": 1000.0,
+                    "intensity_se": 10.0,
+                    "mz": 100.0 + n,
+                    "rt": 60.0,
+                    "experiment": experiment,
+                    "condition": condition,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def test_candidate_pairs():
+    df = mid_table(
+        {
+            ("a", "E1", "T1"): [0.2, 0.3, 0.5],
+            ("b", "E1", "T1"): [0.3, 0.3, 0.4],
+            ("c", "E2", "T1"): [0.1, 0.4, 0.5],
+            ("d", "E2", "T1"): [0.2, 0.2, 0.6],
+            # Not labeled enough to be aligned
+            ("e", "E1", "T1"): [0.95, 0.03, 0.02],
+        }
+    )
+    net = Network(excluded_conditions=[], unlabeled_conditions=[])
+    net.read_pd(df)
+    index = MIDIndex.from_network(net)
+
+    names = [node.name for node in net.nodes]
+    pairs = {(names[i], names[j]) for i, j in index.iter_candidate_pairs()}
+
+    assert pairs == {("a", "b"), ("c", "d")}
+    assert index.candidate_count() == len(pairs)
+
+    # Every range has candidate pairs and together they cover all of them
+    chunks = index.row_chunks(8)
+    chunk_pairs = [list(index.iter_candidate_pairs(*chunk)) for chunk in chunks]
+    assert all(chunk_pairs)
+    assert sum(len(pairs) for pairs in chunk_pairs) == index.candidate_count()
+
+
+def test_candidate_pairs_many_experiments():
+    shape = (4, 70, 1)
+    eligible = np.zeros(shape, dtype=bool)
+    # Only experiments past the 64th are shared
+    eligible[0, [3, 66], 0] = True
+    eligible[1, 66, 0] = True
+    eligible[2, [0, 64], 0] = True
+    eligible[3, [64, 69], 0] = True
+    index = MIDIndex(
+        [f"E{e}" for e in range(shape[1])],
+        ["T1"],
+        np.zeros(shape + (3,)),
+        np.full(shape, 3),
+        eligible,
+        np.zeros(shape, dtype=np.uint64),
+    )
+
+    assert list(index.iter_candidate_pairs()) == [(0, 1), (2, 3)]
+    assert index.candidate_count() == 2
+    blocks = list(index.iter_candidate_mids())
+    assert [block[2].tolist() for block in blocks] == [[66, 64]]
+    assert index.row_chunks(4) == [(0, 1), (2, 3)]
+
+
+def test_setup_connections_disjoint_experiments(tmp_path):
+    df = mid_table(
+        {
+            ("a", "E1", "T1"): [0.2, 0.3, 0.5],
+            ("b", "E2", "T1"): [0.3, 0.3, 0.4],
+        }
+    )
+    net = Network(excluded_conditions=[], unlabeled_conditions=[])
+    net.read_pd(df)
+
+    net.setup_connections(1, store_dir=str(tmp_path))
+
+    assert net.mid_index.row_chunks(16) == []
+    assert net.connections.dtype == CONNECTION_DTYPE
+    assert len(net.connections) == 0
+    assert len(ConnectionStore.open(str(tmp_path)).select()) == 0
+
+
+def test_setup_connections_abandons_pairs(tmp_path):
+    rng = np.random.default_rng(2)
+    df = mid_table(
+        {
+            (f"m{n}", experiment, condition): rng.dirichlet(
+                np.ones(rng.integers(3, 7))
+            )
+            for n in range(12)
+            for experiment in ["E1", "E2"]
+            for condition in ["T1", "T2"]
+        }
+    )
+    net = Network(excluded_conditions=[], unlabeled_conditions=[])
+    net.read_pd(df)
+
+    # The scores of all pairs are stored, so no pair is abandoned
+    net.setup_connections(1, store_dir=str(tmp_path))
+    full = net.connections
+    store = ConnectionStore.open(str(tmp_path))
+    assert len(full) < len(store)
+
+    net.setup_connections(1)
+
+    assert len(full) > 0
+    assert (net.connections == full).all()
+
+
+def test_keep_top_k():
+    connections = np.array(
+        [
+            (0, 1, 0, 0, 0.1),
+            (0, 1, 0, 1, 0.4),
+            (0, 2, 0, 0, 0.2),
+            (0, 3, 0, 0, 0.3),
+            (2, 3, 0, 0, 0.25),
+            (0, 3, 1, 0, 0.6),
+        ],
+        dtype=CONNECTION_DTYPE,
+    )
+    kept = Network.keep_top_k(connections, 1)
+
+    # 0 is the closest partner of 2, but 1 is the closest partner of 0
+    edges = {tuple(edge) for edge in kept[["source", "target", "experiment"]]}
+    assert edges == {(0, 1, 0), (0, 3, 1)}
+    assert len(kept) == 3
+
+
+def test_keep_top_k_caps_degree():
+    rng = np.random.default_rng(0)
+    # Node 0 is a hub close to every other node
+    pairs = [(i, j) for i in range(12) for j in range(i + 1, 12)]
+    connections = np.array(
+        [
+            (i, j, experiment, 0, rng.random() * (0.1 if i == 0 else 1))
+            for i, j in pairs
+            for experiment in range(2)
+        ],
+        dtype=CONNECTION_DTYPE,
+    )
+    kept = Network.keep_top_k(connections, 3)
+
+    nodes = np.concatenate([kept["source"], kept["target"]])
+    experiments = np.concatenate([kept["experiment"], kept["experiment"]])
+    _, degree = np.unique(np.stack([nodes, experiments]), axis=1, return_counts=True)
+    assert degree.max() == 3
+
+
+def test_get_mids():
+    node = NetworkElement("a", 1, 100.0, 60.0)
+    node.add_mids("E1", "T1", [0.2, 0.3, 0.5], [0.01, 0.01, 0.01])
+    node.add_mids("E1", "T2", [0.5, 0.5], [0.01, 0.01])
+
+    mids = node.get_mids("E1", "T1")
+    assert mids.condition == "T1"
+    assert mids.fractional_contribution == pytest.approx(0.65)
+    assert mids.abs_sum == pytest.approx(1.0)
+    assert mids.to_dict()["values"] == [0.2, 0.3, 0.5]
+    assert node.get_mids("E2", "T1") is None
+
+
+def test_read_pd_filters():
+    df = mid_table(
+        {
+            ("a", "E1", "Ctrl"): [0.95, 0.03, 0.02],
+            ("a", "E1", "T1"): [0.2, 0.3, 0.5],
+            ("a", "E2", "T1"): [0.3, 0.3, 0.4],
+            # Labeled in the unlabeled condition
+            ("b", "E1", "Ctrl"): [0.5, 0.3, 0.2],
+            ("b", "E1", "T1"): [0.2, 0.3, 0.5],
+            # Too short
+            ("c", "E1", "T1"): [0.5, 0.5],
+        }
+    )
+    # Nodes are built from MIDs sorted by isotopologue
+    labeled = (df["condition"] == "T1") & (df["experiment"] == "E1")
+    df = pd.concat([df[~labeled], df[labeled].iloc[::-1]], ignore_index=True)
+    net = Network(excluded_conditions=[], unlabeled_conditions=["Ctrl"])
+    net.read_pd(df)
+
+    assert [node.name for node in net.nodes] == ["a"]
+    assert net.nodes[0].get_mids("E1", "T1").to_dict()["values"] == [0.2, 0.3, 0.5]
+
+    net = Network(excluded_conditions=[], unlabeled_conditions=["Ctrl"])
+    net.min_quant = 5000
+    net.read_pd(mid_table({("a", "E1", "T1"): [0.2, 0.3, 0.5]}))
+    assert net.nodes == []
+
+
+def test_read_pathway():
+    df = mid_table(
+        {
+            ("a", "E1", "T1"): [0.2, 0.3, 0.5],
+            ("a", "E2", "T1"): [0.3, 0.3, 0.4],
+        }
+    )
+    df["compound_id"] = 5.0
+    net = Network(excluded_conditions=[], unlabeled_conditions=[])
+    net.read_pd(df)
+    measured = net.nodes[0]
+
+    position = {"x": 1.0, "y": 2.0}
+    net.read_pathway(
+        {
+            "elements": {
+                "nodes": [
+                    {
+                        "data": {"id": "10", "Label": "A", "compound_id": "5"},
+                        "position": position,
+                    },
+                    {"data": {"id": "11", "Label": "B"}, "position": position},
+                ],
+                "edges": [{"data": {"source": "10", "target": "11"}}],
+            }
+        }
+    )
+
+    mapped, pathway_node = net.nodes
+    assert mapped is not measured and mapped.type == "mapped"
+    assert mapped.name == "A" and mapped.get_id() == "10"
+    assert mapped.mids is measured.mids
+    assert pathway_node.type == "pathway" and pathway_node.node_id == 11
+    assert len(net.edges) == 1
+
+
+def test_write_json(tmp_path):
+    df = mid_table(
+        {
+            ("a", "E1", "T1"): [0.2, 0.3, 0.5],
+            ("a", "E2", "T1"): [0.3, 0.3, 0.4],
+        }
+    )
+    df.loc[0, "cis"] = float("inf")
+    net = Network(excluded_conditions=[], unlabeled_conditions=[])
+    net.read_pd(df)
+
+    file_path = tmp_path / "network_graph.json"
+    net.write_json(str(file_path), compressed=True)
+
+    data = json.loads(file_path.read_text())
+    assert data == json.loads(
+        gzip.decompress((tmp_path / "network_graph.json.gz").read_bytes())
+    )
+    assert data["experiments"] == ["E1", "E2"]
+    assert data["nodes"][0]["data"] == net.nodes[0].to_dict()
+    assert data["nodes"][0]["data"]["mids"][0]["err"][0] is None
+
+    # Without compression a copy left by an earlier run is removed
+    net.write_json(str(file_path))
+    assert not (tmp_path / "network_graph.json.gz").exists()
+
+
+def test_connection_store(tmp_path):
+    tasks = [
+        [(0, 1, 0, 1, 0.2, -1.5), (0, 1, 0, 0, 0.1, -2.0)],
+        [],
+        [(1, 2, 0, 1, 0.3, -0.5)],
+    ]
+    shards = [
+        ConnectionStore.write_shard(
+            str(tmp_path), number, np.array(scores, dtype=SCORE_DTYPE)
+        )
+        for number, scores in enumerate(tasks)
+    ]
+    assert shards[1] is None
+
+    ConnectionStore.save(
+        str(tmp_path), shards[::2], ["a", "b", "c"], ["E1"], ["T1", "T2"]
+    )
+    store = ConnectionStore.open(str(tmp_path))
+
+    assert len(store) == 3
+    # Shards are sorted and listed in task order
+    assert store.select(0)[["source", "target", "conditions"]].tolist() == [
+        (0, 1, 0),
+        (0, 1, 1),
+        (1, 2, 1),
+    ]
+    assert len(store.select(0)) == 3
+    assert len(store.select(-1, max_distance=0.15)) == 1
+
+    edges = [
+        edge.to_dict()
+        for edge in connection_edges(
+            store.select(-1), store.nodes, store.experiments, store.conditions
+        )
+    ]
+    assert len(edges) == 1
+    assert edges[0]["source"] == "a" and edges[0]["target"] == "b"
+    assert list(edges[0]["connections"]) == ["T1_T1", "T1_T2"]
+
+    ConnectionStore.remove(str(tmp_path))
+    assert not ConnectionStore.exists(str(tmp_path))
+    assert not list(tmp_path.glob("*.npy"))
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+from app.components.schemas import MID_TABLE, TARGETED_TABLE
+from app.components.utils import UserInputError
+
+
+def targeted_table():
+    return pd.DataFrame(
+        {
+            "name": ["Pyruvate", "Pyruvate", "Lactate"],
+            "experiment": [1, 1, 2],
+            "condition": ["Ctrl", "T1", "Ctrl"],
+            "reference": ["c1", "t1", "c1"],
+            "mass_isotopomer": ["M+0", "M+0", "M+0"],
+            "intensity": [1.0, 2.0, 3.0],
+        }
+    )
+
+
+def test_apply_keeps_values():
+    df = TARGETED_TABLE.apply(targeted_table())
+
+    assert df["name"].dtype == "category"
+    assert list(df["name"]) == ["Pyruvate", "Pyruvate", "Lactate"]
+    # Categories keep the parsed values
+    assert list(df["experiment"].cat.categories) == [1, 2]
+    assert df["mass_isotopomer"].dtype == object
+    assert df["intensity"].dtype == "float64"
+
+
+def test_apply_validates_columns():
+    with pytest.raises(UserInputError, match="Missing required columns: mids, cis"):
+        MID_TABLE.apply(pd.DataFrame(columns=MID_TABLE.required[:3]))
+
+    df = targeted_table()
+    df["intensity"] = ["1.0", "n/a", "3.0"]
+    with pytest.raises(UserInputError, match="must be numeric: intensity"):
+        TARGETED_TABLE.apply(df)
+
+
+def test_read_upload():
+    content = b"name;experiment;condition;reference;mass_isotopomer;intensity\n"
+    content += b"Pyruvate;1;Ctrl;c1;M+0;1.5\n"
+
+    df = TARGETED_TABLE.read_upload(content, delimiter=None)
+
+    assert df["condition"].dtype == "category"
+    assert df["intensity"].tolist() == [1.5]
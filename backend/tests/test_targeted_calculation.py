@@ -0,0 +1,125 @@
+import pandas as pd
+import pytest
+from app.components.targeted_calculation import (
+    calculate_mid,
+    fill_missing_measurements,
+)
+from app.components.utils import UserInputError
+
+
+def targeted_data(intensities):
+    return pd.DataFrame(
+        [
+            {
+                "name": name,
+                "experiment": 1,
+                "condition": condition,
+                "reference": reference,
+                "mass_isotopomer": f"M+{k}",
+                "intensity": intensity,
+            }
+            for name, samples in intensities.items()
+            for reference, (condition, values) in samples.items()
+            for k, intensity in enumerate(values)
+        ]
+    )
+
+
+def test_calculate_mid():
+    df = targeted_data(
+        {
+            "Pyruvate": {
+                "c1": ("Ctrl", [90.0, 8.0, 2.0]),
+                "c2": ("Ctrl", [90.0, 8.0, 2.0]),
+                # Natural abundance only, and fully labeled
+                "t1": ("T1", [90.0, 8.0, 2.0]),
+                "t2": ("T2", [0.0, 0.0, 100.0]),
+            },
+            "Lactate": {
+                "c1": ("Ctrl", [95.0, 5.0]),
+                "t1": ("T1", [45.0, 55.0]),
+            },
+        }
+    )
+
+    data = calculate_mid(df, "Ctrl")
+
+    assert list(data) == ["Pyruvate", "Lactate"]
+    assert list(data["Pyruvate"]) == ["1"]
+    pyruvate = data["Pyruvate"]["1"]
+    assert [(row["condition"], row["isotopomer"]) for row in pyruvate] == [
+        ("T1", "M+0"),
+        ("T2", "M+0"),
+        ("T1", "M+1"),
+        ("T2", "M+1"),
+        ("T1", "M+2"),
+        ("T2", "M+2"),
+    ]
+    assert [row["mean"] for row in pyruvate[::2]] == pytest.approx([1, 0, 0])
+    assert pyruvate[-1]["mean"] > 0.9
+    assert len(data["Lactate"]["1"]) == 2
+
+
+def test_calculate_mid_fills_missing_isotopomers():
+    df = targeted_data(
+        {
+            "Pyruvate": {
+                "c1": ("Ctrl", [90.0, 8.0, 2.0]),
+                "t1": ("T1", [90.0, 8.0, 2.0]),
+            }
+        }
+    )
+    # t1 has no M+2 and is filled in with zero intensity
+    df = df[(df["reference"] != "t1") | (df["mass_isotopomer"] != "M+2")]
+
+    data = calculate_mid(df, "Ctrl")
+
+    assert [row["isotopomer"] for row in data["Pyruvate"]["1"]] == [
+        "M+0",
+        "M+1",
+        "M+2",
+    ]
+
+
+def test_fill_missing_measurements():
+    df = pd.DataFrame(
+        {
+            "condition": ["Ctrl", "Ctrl", "Ctrl", "T1", "T1", "T1"],
+            "mass_isotopomer": ["M+0", "M+1", "M+2", "M+0", "M+1", "M+0"],
+            "relative_intensity": [0.7, 0.2, 0.1, 0.5, 0.5, 1.0],
+            "experiment": 1,
+            "sample": ["c1", "c1", "c1", "t1", "t1", "t2"],
+            "reference": ["c1", "c1", "c1", "t1", "t1", "t2"],
+            "name": "Pyruvate",
+        }
+    )
+
+    filled = fill_missing_measurements(df)
+
+    assert list(filled["sample"]) == ["c1"] * 3 + ["t1"] * 3 + ["t2"] * 3
+    assert list(filled["mass_isotopomer"]) == ["M+0", "M+1", "M+2"] * 3
+    assert list(filled["relative_intensity"]) == [
+        0.7,
+        0.2,
+        0.1,
+        0.5,
+        0.5,
+        0,
+        1.0,
+        0,
+        0,
+    ]
+    assert list(filled["replicate"].fillna("")) == [""] * 5 + [
+        "filled",
+        "",
+        "filled",
+        "filled",
+    ]
+
+
+def test_calculate_mid_isotopomer_format():
+    df = targeted_data({"Pyruvate": {"c1": ("Ctrl", [90.0, 10.0])}})
+    df["mass_isotopomer"] = ["M0", "M1"]
+
+    with pytest.raises(UserInputError):
+        calculate_mid(df, "Ctrl")
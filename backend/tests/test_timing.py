@@ -0,0 +1,58 @@
+import json
+
+import pytest
+from app.components.timing import TIMINGS_FILE, Timings, timed_call
+
+
+class RecordingManager:
+    def __init__(self):
+        self.timings = []
+
+    def send_timing(self, session_id, timing):
+        self.timings.append((session_id, timing))
+
+
+def test_span_records_stage():
+    manager = RecordingManager()
+    timings = Timings("calculation", manager, "session")
+
+    with timings.span("cleaning") as span:
+        sum(range(10000))
+        span["items"] = 3
+    with pytest.raises(ValueError):
+        with timings.span("fitting", 5):
+            raise ValueError("failed")
+
+    assert [span["stage"] for span in timings.spans] == ["cleaning", "fitting"]
+    assert [span["items"] for span in timings.spans] == [3, 5]
+    assert all(span["wall_time"] >= 0 for span in timings.spans)
+    assert all(span["cpu_time"] >= 0 for span in timings.spans)
+    assert manager.timings == [("session", span) for span in timings.spans]
+
+
+def test_span_adds_worker_cpu_time():
+    timings = Timings("context")
+
+    with timings.span("alignment") as span:
+        for task in [10000, 20000]:
+            result, worker_cpu_time = timed_call(sum, range(task))
+            span["worker_cpu_time"] += worker_cpu_time
+        span["worker_cpu_time"] += 2.0
+
+    assert result == sum(range(20000))
+    assert timings.spans[0]["cpu_time"] >= 2.0
+    assert "worker_cpu_time" not in timings.spans[0]
+
+
+def test_write_keeps_other_jobs(tmp_path):
+    for job in ["calculation", "context", "calculation"]:
+        timings = Timings(job)
+        with timings.span(f"{job} stage"):
+            pass
+        timings.write(str(tmp_path))
+
+    with open(tmp_path / TIMINGS_FILE) as file:
+        stored = json.load(file)
+
+    assert sorted(stored) == ["calculation", "context"]
+    assert [span["stage"] for span in stored["calculation"]] == ["calculation stage"]
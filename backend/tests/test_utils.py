@@ -0,0 +1,67 @@
+import codecs
+
+import pandas as pd
+import pytest
+from app.components import utils
+from app.components.utils import (
+    ENCODING_SAMPLE_SIZE,
+    decode_upload,
+    detect_encoding,
+    read_upload_table,
+)
+from fastapi import HTTPException
+
+
+def test_detect_encoding():
+    assert detect_encoding(codecs.BOM_UTF8 + b"name,value\n") == "utf-8-sig"
+    assert detect_encoding("name,value\n".encode("utf-16")) == "utf-16"
+    assert detect_encoding("name,välue\nä,1\n".encode("utf-8")) == "utf-8"
+    with pytest.raises(HTTPException) as error:
+        detect_encoding(b"")
+    assert error.value.status_code == 422
+
+
+@pytest.mark.parametrize("detected", [None, "ascii", "unknown-codec"])
+def test_detect_encoding_undecodable(monkeypatch, detected):
+    monkeypatch.setattr(utils.chardet, "detect", lambda sample: {"encoding": detected})
+
+    with pytest.raises(HTTPException) as error:
+        detect_encoding(b"name,value\n\xff\xfe\xfa,1\n")
+    assert error.value.status_code == 422
+
+
+def test_decode_upload_outside_sample():
+    text = "a" * ENCODING_SAMPLE_SIZE + "Glücose\n"
+
+    assert decode_upload(text.encode("latin-1")) == text
+
+
+def test_read_upload_table():
+    content = "name;condition;intensity\nGlücose;Ctrl;1.5\nLactate;T1;2\n"
+
+    df = read_upload_table(content.encode("latin-1"), delimiter=None)
+
+    assert list(df.columns) == ["name", "condition", "intensity"]
+    assert list(df["name"]) == ["Glücose", "Lactate"]
+    assert list(df["intensity"]) == [1.5, 2.0]
+
+
+def test_read_upload_table_outside_sample():
+    rows = "".join(f"Pyruvate,{i}\n" for i in range(ENCODING_SAMPLE_SIZE // 10))
+    content = ("name,value\n" + rows + "Glücose,1\n").encode("latin-1")
+
+    df = read_upload_table(content)
+
+    assert df["name"].iloc[-1] == "Glücose"
+
+
+def test_read_upload_table_malformed(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        utils, "detect_encoding", lambda *args: calls.append(args) or "utf-8"
+    )
+
+    # A malformed table is not parsed again with full-file detection
+    with pytest.raises(pd.errors.ParserError):
+        read_upload_table(b"name,value\na,1\nb,2,3\n")
+    assert len(calls) == 1